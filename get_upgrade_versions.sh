@@ -3,6 +3,7 @@ set -eo pipefail
 
 COMPONENT=""
 BRANCH=""
+JSON=""
 
 while [[ $# -ge 1 ]]
 do
@@ -26,6 +27,9 @@ case ${key} in
     BASE_RELEASEPACK_VERSIONS="$ARG"
   fi
   ;;
+  --json)
+  JSON="true"
+  ;;
 esac
 shift
 done
@@ -52,13 +56,27 @@ get_vsolution_version() {
   echo $VERSION
 }
 
-if [ -z "$COMPONENT" ]; then
-  echoerr "#### [level=error] COMPONENT variable is not set, e.g. --component=VFLOW. Supported options are VFLOW, RELEASEPACK, APP_BASE, APP_DATA, HANALITE, VSYSTEM, STORAGEGATEWAY, FLOWAGENT, DIAGNOSTICS, CODE_SERVER, AXINO, ML_API, ML_DM_API, ML_TRACKING, DQ_INTEGRATION"
+if [[ -z "$BRANCH" && -z "$BASE_RELEASEPACK_VERSIONS" ]]; then
+  echoerr "### [level=error] --branch or --base-version must be set"
   exit 1
 fi
 
-if [[ -z "$BRANCH" && -z "$BASE_RELEASEPACK_VERSIONS" ]]; then
-  echoerr "### [level=error] --branch or --base-version must be set"
+# Batch mode: resolve all components (or only COMPONENT) for all base versions in one process and print JSON
+if [ -n "$JSON" ]; then
+  ARGS=(--json)
+  if [ -n "$COMPONENT" ]; then
+    ARGS+=(--component="$COMPONENT")
+  fi
+  if [ -n "$BASE_RELEASEPACK_VERSIONS" ]; then
+    ARGS+=(--base-version $BASE_RELEASEPACK_VERSIONS)
+  else
+    ARGS+=(--branch="$BRANCH")
+  fi
+  exec python3 "$(dirname "$0")/pylibs/versioning.py" "${ARGS[@]}"
+fi
+
+if [ -z "$COMPONENT" ]; then
+  echoerr "#### [level=error] COMPONENT variable is not set, e.g. --component=VFLOW. Supported options are VFLOW, RELEASEPACK, APP_BASE, APP_DATA, HANALITE, VSYSTEM, STORAGEGATEWAY, FLOWAGENT, DIAGNOSTICS, CODE_SERVER, AXINO, ML_API, ML_DM_API, ML_TRACKING, DQ_INTEGRATION"
   exit 1
 fi
 
@@ -0,0 +1,131 @@
+import fnmatch
+import io
+import os
+import posixpath
+import tarfile
+import zipfile
+
+
+def matches_any(path, patterns):
+    """Find out whether a path matches any of the given glob patterns."""
+    return any(fnmatch.fnmatchcase(path, p) for p in patterns)
+
+
+def normalize_path(path):
+    """Normalize a path within an archive, e.g. ./foo/bar/ -> foo/bar. The archive root is ''."""
+    path = posixpath.normpath("/" + path).lstrip("/")
+    return "" if path == "." else path
+
+
+class Archive():
+    """Read-only access to the members of a zip or tar.gz archive, without unpacking it to disk.
+    Paths are relative to the archive root and use '/' as separator.
+    NB: tar.gz archives cannot be accessed randomly, so reading their members in archive order is cheapest."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.zip = None
+        self.tar = None
+        if filename.endswith(".zip"):
+            self.zip = zipfile.ZipFile(filename)
+            infos = self.zip.infolist()
+            dirs = [m.filename for m in infos if m.is_dir()]
+            members = [(m.filename, m) for m in infos if not m.is_dir()]
+        elif filename.endswith(".tar.gz") or filename.endswith(".tgz"):
+            self.tar = tarfile.open(filename, "r:gz")
+            infos = self.tar.getmembers()
+            dirs = [m.name for m in infos if m.isdir()]
+            members = [(m.name, m) for m in infos if not m.isdir()]
+        else:
+            raise ValueError("Unsupported archive format: " + filename)
+
+        # Build a directory tree: directory path -> (subdirectory names, file names)
+        self.members = {}
+        self.dirs = {"": (set(), set())}
+        for d in dirs:
+            self.add_dir(normalize_path(d))
+        for name, member in members:
+            path = normalize_path(name)
+            self.members[path] = member
+            parent, base = posixpath.split(path)
+            self.add_dir(parent)
+            self.dirs[parent][1].add(base)
+
+    def add_dir(self, path):
+        if path in self.dirs:
+            return
+        self.dirs[path] = (set(), set())
+        parent, base = posixpath.split(path)
+        self.add_dir(parent)
+        self.dirs[parent][0].add(base)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        if self.tar:
+            self.tar.close()
+
+    def namelist(self):
+        """Return the paths of all files (and links) in the archive."""
+        return list(self.members)
+
+    def isfile(self, path):
+        path = normalize_path(path)
+        if self.tar and path in self.members:
+            return self.members[path].isfile()
+        return path in self.members
+
+    def isdir(self, path):
+        return normalize_path(path) in self.dirs
+
+    def walk(self, top=""):
+        """Walk the directory tree below top, analogous to os.walk (top-down).
+        Like with os.walk, subdirectories can be pruned by modifying dirnames in place."""
+        top = normalize_path(top)
+        if top not in self.dirs:
+            return
+        subdirs, files = self.dirs[top]
+        dirnames = sorted(subdirs)
+        yield top, dirnames, sorted(files)
+        for d in dirnames:
+            yield from self.walk(posixpath.join(top, d))
+
+    def open(self, path, mode="r", encoding="UTF-8"):
+        """Open a file in the archive for reading. Mode is either 'r' (text) or 'rb' (binary)."""
+        path = normalize_path(path)
+        if not self.isfile(path):
+            raise FileNotFoundError("{} not found in {}".format(path, self.filename))
+        if self.zip:
+            f = self.zip.open(self.members[path])
+        else:
+            f = self.tar.extractfile(self.members[path])
+        if mode == "rb":
+            return f
+        return io.TextIOWrapper(f, encoding=encoding)
+
+    def extract(self, outdir, include=None, exclude=None):
+        """Extract the files matching any of the include patterns (default: all) and none of the exclude
+        patterns into outdir. Returns the number of extracted files."""
+        paths = [p for p in self.members if (include is None or matches_any(p, include))
+                 and not (exclude and matches_any(p, exclude))]
+        os.makedirs(outdir, exist_ok=True)
+        if self.zip:
+            for path in paths:
+                member = self.members[path]
+                target = self.zip.extract(member, outdir)
+                mode = (member.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(target, mode)
+        else:
+            members = [self.members[p] for p in paths]
+            if hasattr(tarfile, "tar_filter"):
+                self.tar.extractall(outdir, members=members, filter="tar")
+            else:
+                self.tar.extractall(outdir, members=members)
+        return len(paths)
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import itertools
 from difflib import SequenceMatcher
 
 class Diff:
@@ -23,50 +24,84 @@ class Diff:
         return ret
 
 
-def diff_list(list1, list2, path, diff):
-    """Calculate the difference between two lists."""
+def path_tuple(link):
+    """Return the path of a linked path, i.e. nested pairs (parent link, key) with None as root, as tuple.
+    Linked paths share their prefixes, so they are built only for the paths of actual differences."""
+    keys = []
+    while link is not None:
+        link, key = link
+        keys.append(key)
+    return tuple(reversed(keys))
+
+
+def iter_diff_list(list1, list2, link):
+    """Yield the differences between two lists."""
     try:
         # TODO: fails if a list contains unhashable types, e.g. dict
         list_diff = SequenceMatcher(a=list1, b=list2).get_opcodes()
-        for opcode, beg1, end1, beg2, end2 in list_diff:
-            if opcode == 'equal':
-                pass
-            elif opcode == 'insert':
-                for i in range(beg2, end2):
-                    diff.append(Diff("added-entry", path+[i], None, list2[i]))
-            elif opcode == 'delete':
-                for i in range(beg1, end1):
-                    diff.append(Diff("removed-entry", path+[i], list1[i], None))
-            elif opcode == 'replace':
-                # TODO: 'replace' might actually add/del elements
-                # e.g. from [1,2]<->[1,3,4] is reported as change from [2] to [3,4]
-                if end1-beg1 == 1 and end2-beg2 == 1:
-                    diff.append(Diff("changed-entry", path+[beg1], list1[beg1], list2[beg2]))
-                else:
-                    diff.append(Diff("changed-entry", path+[beg1], list1[beg1:end1], list2[beg2:end2]))
+    except TypeError:  # e.g. "unhashable type: dict"
+        if list1 != list2:
+            yield Diff("changed-entry", path_tuple(link), list1, list2)
+        return
+    for opcode, beg1, end1, beg2, end2 in list_diff:
+        if opcode == 'equal':
+            pass
+        elif opcode == 'insert':
+            for i in range(beg2, end2):
+                yield Diff("added-entry", path_tuple((link, i)), None, list2[i])
+        elif opcode == 'delete':
+            for i in range(beg1, end1):
+                yield Diff("removed-entry", path_tuple((link, i)), list1[i], None)
+        elif opcode == 'replace':
+            # TODO: 'replace' might actually add/del elements
+            # e.g. from [1,2]<->[1,3,4] is reported as change from [2] to [3,4]
+            if end1-beg1 == 1 and end2-beg2 == 1:
+                yield Diff("changed-entry", path_tuple((link, beg1)), list1[beg1], list2[beg2])
             else:
-                raise Exception("unknown SequenceMatcher opcode: " + opcode)
-    except TypeError: # e.g. "unhashable type: dict"
-        diff.append(Diff("changed-entry", path, list1, list2))
+                yield Diff("changed-entry", path_tuple((link, beg1)), list1[beg1:end1], list2[beg2:end2])
+        else:
+            raise Exception("unknown SequenceMatcher opcode: " + opcode)
 
 
-def diff_tree(tree1, tree2, path=[]):
-    """Calculate the difference between two tree-shaped dicts."""
-    diff = []
+def iter_diff_tree(tree1, tree2, link):
+    """Yield the differences between two trees, for a linked path (see path_tuple)."""
     if type(tree1) != type(tree2):
-        diff.append(Diff("changed-type", path, tree1, tree2))
-        return diff
+        yield Diff("changed-type", path_tuple(link), tree1, tree2)
+        return
+    if tree1 is tree2:
+        return
     if isinstance(tree1, dict):
-        for k in set(tree1.keys()) | set(tree2.keys()):
-            if not k in tree1:  # key in tree2 but not in tree1 ==> inserted in tree2
-                diff.append(Diff("added-entry", path + [k], None, tree2[k]))
-            elif not k in tree2:  # key in tree1 but not in tree2 ==> deleted from tree2
-                diff.append(Diff("removed-entry", path + [k], tree1[k], None))
+        # keys in the order of tree1, followed by the keys only in tree2, so the order of differences is stable
+        for k in tree1:
+            if not k in tree2:  # key in tree1 but not in tree2 ==> deleted from tree2
+                yield Diff("removed-entry", path_tuple((link, k)), tree1[k], None)
             else:
-                diff += diff_tree(tree1[k], tree2[k], path + [k])
+                yield from iter_diff_tree(tree1[k], tree2[k], (link, k))
+        for k in tree2:
+            if not k in tree1:  # key in tree2 but not in tree1 ==> inserted in tree2
+                yield Diff("added-entry", path_tuple((link, k)), None, tree2[k])
     elif isinstance(tree1, list):
-        diff_list(tree1, tree2, path, diff)
+        yield from iter_diff_list(tree1, tree2, link)
     else:
         if tree1 != tree2:
-            diff.append(Diff("changed-entry", path, tree1, tree2))
-    return diff
+            yield Diff("changed-entry", path_tuple(link), tree1, tree2)
+
+
+def iter_diff(tree1, tree2, path=(), limit=None):
+    """Yield the differences between two tree-shaped dicts lazily, at most limit (default: all) of them.
+    The path of each Diff is a tuple starting with the given path."""
+    link = None
+    for key in path:
+        link = (link, key)
+    return itertools.islice(iter_diff_tree(tree1, tree2, link), limit)
+
+
+def diff_tree(tree1, tree2, path=[], limit=None):
+    """Calculate the difference between two tree-shaped dicts, as list of at most limit (default: all) Diffs.
+    See iter_diff."""
+    return list(iter_diff(tree1, tree2, path, limit))
+
+
+def any_difference(tree1, tree2):
+    """Find out whether two trees differ (i.e. iter_diff yields anything), stopping at the first difference."""
+    return next(iter_diff(tree1, tree2), None) is not None
@@ -1,18 +1,32 @@
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
 import json
 import logging as log
 import os
-import platform
 import re
+import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+import zipfile
+import zlib
 
 import xml.etree.ElementTree as XML
 import requests
 import urllib3
-urllib3.disable_warnings()
 
-from pylibs.logstream import LogStream
+from pylibs import httpclient, telemetry
+from pylibs.archive import Archive, matches_any
+from pylibs.logstream import run_logged
+from pylibs.httpclient import RateLimiter, RetryPolicy, get_rate_limiter, get_retry_policy
 
 # TODO: functions are somewhat inconsistent wrt. error behaviour:
 # some return None, some return False, others raise exceptions.
@@ -25,13 +39,15 @@ from pylibs.logstream import LogStream
 def parse_xml(url):
     """Parse XML file, ignoring pesky namespaces."""
     output = read_from_url_or_file(url)
-    try:
-        xml_tree = XML.fromstring(output)
-    except XML.ParseError as ex:
-        log.error("parsing XML failed for %s: %s", output, ex)
-        sys.exit(-1)
-    for elem in xml_tree.iter():
-        _ns, elem.tag = re.match(r"(\{[^{}]+\})?(.+)", elem.tag).groups()
+    with telemetry.measure("parse-xml") as m:
+        m.bytes = len(output)
+        try:
+            xml_tree = XML.fromstring(output)
+        except XML.ParseError as ex:
+            log.error("parsing XML failed for %s: %s", output, ex)
+            sys.exit(-1)
+        for elem in xml_tree.iter():
+            _ns, elem.tag = re.match(r"(\{[^{}]+\})?(.+)", elem.tag).groups()
     return xml_tree
 
 
@@ -54,8 +70,10 @@ def xml_replace_namespaces(xml_tree, namespace_map):
 def dig_in_xml(url, path, namespace_map={}, firstonly=False):
     """Get the content of an element in an XML file for a given URL."""
     output = read_from_url_or_file(url)
-    xml_tree = XML.fromstring(output)
-    xml_replace_namespaces(xml_tree, namespace_map)
+    with telemetry.measure("parse-xml") as m:
+        m.bytes = len(output)
+        xml_tree = XML.fromstring(output)
+        xml_replace_namespaces(xml_tree, namespace_map)
 
     if firstonly:
         find_func = xml_tree.find
@@ -70,6 +88,75 @@ def dig_in_xml(url, path, namespace_map={}, firstonly=False):
     else:
         return find_func(path)
 
+
+# XML paths extracted from POM files by read_pom
+POM_PATHS = ("properties/*", "dependencies/dependency")
+
+_xml_extracts = {}
+_xml_extracts_lock = threading.Lock()
+
+
+def iterparse_string(url, output, chunk_size=64 * 1024):
+    """Yield the (event, element) pairs of 'start' and 'end' events while parsing an XML string chunk-wise.
+    Raises XML.ParseError if the string is not well-formed XML (e.g. empty, if the download failed)."""
+    parser = XML.XMLPullParser(events=("start", "end"))
+    try:
+        for i in range(0, len(output), chunk_size):
+            parser.feed(output[i:i + chunk_size])
+            yield from parser.read_events()
+        parser.close()
+    except XML.ParseError as ex:
+        log.error("parsing XML failed for %s: %s", url, ex)
+        raise
+    yield from parser.read_events()
+
+
+def extract_from_xml(url, paths):
+    """Extract the elements matching any of the given paths from an XML file in a single streaming pass,
+    ignoring namespaces. Paths are relative to the root element and may contain glob patterns,
+    e.g. 'properties/hldep.*.version'. Returns a dict mapping each of the paths to a list of (path, value)
+    pairs of the matching elements, in document order. The value of an element is its text or, if it has
+    child elements, a dict mapping the names of the children to their text.
+    Raises XML.ParseError if the file cannot be parsed.
+    Results are memoized per URL, so each file is downloaded and parsed only once per process."""
+    key = (url, tuple(paths))
+    with _xml_extracts_lock:
+        if key in _xml_extracts:
+            return _xml_extracts[key]
+    output = read_from_url_or_file(url)
+    result = {p: [] for p in paths}
+    stack = []
+    with telemetry.measure("parse-xml") as m:
+        m.bytes = len(output)
+        for event, elem in iterparse_string(url, output):
+            if event == "start":
+                stack.append(elem.tag.rpartition("}")[2])
+                continue
+            path = "/".join(stack[1:])
+            for p in paths:
+                if fnmatch.fnmatchcase(path, p):
+                    if len(elem):
+                        value = {child.tag.rpartition("}")[2]: (child.text or "").strip() for child in elem}
+                    else:
+                        value = (elem.text or "").strip()
+                    result[p].append((path, value))
+            stack.pop()
+            if len(stack) == 1:
+                elem.clear()  # all paths below this element have been matched
+    with _xml_extracts_lock:
+        return _xml_extracts.setdefault(key, result)
+
+
+def read_pom(url):
+    """Read the properties and dependencies from a POM file (Maven XML).
+    Returns a dict with 'properties' (name -> text) and 'dependencies' (a list of dicts with groupId,
+    artifactId, version, and optionally type and classifier)."""
+    result = extract_from_xml(url, POM_PATHS)
+    return {
+        "properties": {path.partition("/")[2]: value for path, value in result["properties/*"]},
+        "dependencies": [value for _, value in result["dependencies/dependency"] if isinstance(value, dict)],
+    }
+
 ## JSON ####
 
 
@@ -78,7 +165,9 @@ def read_json_from(url):
     output = read_from_url_or_file(url)
     if len(output) == 0 or output[0] != '{':  # check if this is actually JSON
         raise(Exception("Error: no proper JSON found at " + url + ": " + output))
-    return json.loads(output)
+    with telemetry.measure("parse-json") as m:
+        m.bytes = len(output)
+        return json.loads(output)
 
 ## Arbitrary text files ####
 
@@ -88,66 +177,573 @@ def read_regex_from(url, regex):
     output = read_from_url_or_file(url)
     return re.findall(regex, output)
 
+#### Local fetch cache ####################################################
+
+# Fetched files are cached on disk. Set UPGRADE_VALIDATION_CACHE_DIR to an empty string to disable caching.
+CACHE_DIR = os.getenv("UPGRADE_VALIDATION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "upgrade-validation"))
+CACHE_TTL = int(os.getenv("UPGRADE_VALIDATION_CACHE_TTL", 600))  # seconds, for mutable refs like branches
+CACHE_MAX_BYTES = int(os.getenv("UPGRADE_VALIDATION_CACHE_MAX_BYTES", 1024 ** 3))
+CACHE_FLUSH_PUTS = 200  # number of puts after which the index is written to disk
+CACHE_ORPHAN_AGE = 24 * 3600  # seconds after which blobs without index entries are removed
+
+
+def is_immutable_ref(ref):
+    """Find out whether a git ref always points to the same content, i.e. it is a release tag or a commit id."""
+    return re.match(r"^(rel/)?[0-9]+\.[0-9]+\.[0-9]+(-ms)?(-dis\.[0-9]+)?$", ref) is not None or is_commit_id(ref)
+
+
+def is_immutable_url(url):
+    """Find out whether a URL points to published content that never changes, e.g. a file of a release tag on
+    GitHub or a released artifact on Artifactory."""
+    if re.search(r"/raw/[^/]+/[^/]+/rel/[0-9]+\.[0-9]+\.[0-9]+[^/]*/", url):
+        return True
+    return re.search(r"/artifactory/build-releases/.+/[0-9]+\.[0-9]+\.[0-9]+[^/]*/[^/]+$", url) is not None
+
+
+class FetchCache():
+    """On-disk cache for fetched files.
+    File contents are stored as blobs named by their sha256 hash. An index maps keys, e.g. (repo, ref, path)
+    or (url,), to blobs. Entries for immutable refs never expire, all others expire after ttl seconds.
+    If the blobs exceed max_bytes in total, the least recently used entries are evicted.
+    The index is kept in memory and written to disk in batches (see save_index)."""
+
+    def __init__(self, cache_dir, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        self.removed = set()
+        self.dirty = False
+        self.puts = 0
+        self.swept = False
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        self.index = self.load_index()
+        atexit.register(self.flush)
+
+    def load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def blob_path(self, sha):
+        return os.path.join(self.cache_dir, "blobs", sha[:2], sha)
+
+    def get(self, *key):
+        """Return the cached content for the given key, or None if there is no valid entry.
+        The blob is read and verified without holding the lock, so concurrent lookups do not wait for each other."""
+        key = json.dumps(key)
+        now = time.time()
+        with self.lock:
+            entry = self.index.get(key)
+            if not entry or (not entry["immutable"] and now - entry["stored"] > self.ttl):
+                return None
+            sha = entry["sha256"]
+        try:
+            with open(self.blob_path(sha), "rb") as f:
+                data = f.read()
+        except OSError:
+            data = None
+        valid = data is not None and hashlib.sha256(data).hexdigest() == sha
+        with self.lock:
+            entry = self.index.get(key)
+            # the entry may have been replaced or removed by another thread in the meantime
+            if entry and entry["sha256"] == sha:
+                if valid:
+                    entry["accessed"] = now
+                    self.dirty = True
+                else:
+                    log.debug("dropping broken cache entry %s", key)
+                    self.remove(key)
+        return data.decode("UTF-8") if valid else None
+
+    def put(self, content, immutable, *key):
+        """Store content for the given key. Immutable entries never expire.
+        The index is written to disk every CACHE_FLUSH_PUTS puts and at exit (see flush)."""
+        key = json.dumps(key)
+        data = content.encode("UTF-8")
+        sha = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(sha)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        now = time.time()
+        with self.lock:
+            self.index[key] = {"sha256": sha, "size": len(data), "immutable": immutable, "stored": now, "accessed": now}
+            self.removed.discard(key)
+            self.dirty = True
+            self.puts += 1
+            if self.puts >= CACHE_FLUSH_PUTS:
+                self.save_index()
+
+    def remove(self, key):
+        del self.index[key]
+        self.removed.add(key)
+        self.dirty = True
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into max_bytes. Must be called with lock held."""
+        refs = collections.Counter(e["sha256"] for e in self.index.values())
+        blob_sizes = {e["sha256"]: e["size"] for e in self.index.values()}
+        total = sum(blob_sizes.values())
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["accessed"]):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            refs[entry["sha256"]] -= 1
+            if not refs[entry["sha256"]]:
+                total -= entry["size"]
+                try:
+                    os.remove(self.blob_path(entry["sha256"]))
+                except OSError:
+                    pass
+
+    def remove_orphans(self):
+        """Remove blobs which are not referenced by the index (e.g. left by processes which were killed) and
+        are older than CACHE_ORPHAN_AGE. Younger blobs might belong to entries of other processes which have
+        not been written yet. Must be called with lock held."""
+        refs = {e["sha256"] for e in self.index.values()}
+        now = time.time()
+        for dirpath, _dirnames, filenames in os.walk(os.path.join(self.cache_dir, "blobs")):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if filename not in refs and now - os.path.getmtime(path) > CACHE_ORPHAN_AGE:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def save_index(self):
+        """Write the index to disk, merging in entries added by other processes in the meantime, and evict
+        entries if the cache exceeds its size limit. Must be called with lock held.
+        The index file is locked while merging, so concurrent processes do not lose each other's entries."""
+        with file_lock(self.index_file, log.debug):
+            on_disk = self.load_index()
+            for key, entry in on_disk.items():
+                if key in self.removed:
+                    continue
+                if key not in self.index or entry["accessed"] > self.index[key]["accessed"]:
+                    self.index[key] = entry
+            if not self.swept:
+                self.remove_orphans()
+                self.swept = True
+            self.evict()
+            tmp = "{}.{}.tmp".format(self.index_file, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.index_file)
+        self.removed.clear()
+        self.dirty = False
+        self.puts = 0
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save_index()
+
+
+_fetch_cache = None
+_fetch_cache_lock = threading.Lock()
+
+
+def get_fetch_cache():
+    """Return the process-wide fetch cache, or None if caching is disabled.
+    The cache is also disabled when recording or replaying responses, so that every fetch goes to the bundle."""
+    global _fetch_cache
+    if httpclient.get_bundle():
+        return None
+    with _fetch_cache_lock:
+        if _fetch_cache is None and CACHE_DIR:
+            _fetch_cache = FetchCache(CACHE_DIR)
+    return _fetch_cache
+
+#### Local git mirrors #####################################################
+
+# Backend used by get_from_github(): "http" fetches raw files, "git" reads them from local mirrors.
+FETCH_BACKEND = os.getenv("UPGRADE_VALIDATION_FETCH_BACKEND", "http")
+MIRROR_DIR = os.getenv("UPGRADE_VALIDATION_MIRROR_DIR", os.path.join(os.path.expanduser("~"), ".cache", "upgrade-validation", "mirrors"))
+
+
+def git_log(line):
+    log.debug("git: %s", line)
+
+
+class GitMirror():
+    """Local bare mirror of a corporate GitHub repository.
+    The mirror is created or incrementally updated with 'git fetch' once per process. Files are read
+    through a single long-lived 'git cat-file --batch' process, so reads do not need any network access."""
+
+    def __init__(self, repo, mirror_dir=MIRROR_DIR):
+        self.repo = repo
+        self.path = os.path.join(mirror_dir, repo + ".git")
+        self.lock = threading.Lock()
+        self.proc = None
+        self.updated = False
+
+    def git_env(self):
+        """Return the environment for git commands, passing credentials via config instead of the command line."""
+        env = dict(os.environ)
+        config = [("http.sslVerify", "false")]
+        github_token = get_github_token()
+        if github_token:
+            config.append(("credential.helper", "!f() { echo username=di-upgrade-validation-bot; echo password=$UPGRADE_VALIDATION_GITHUB_TOKEN; }; f"))
+        env["GIT_CONFIG_COUNT"] = str(len(config))
+        for i, (key, value) in enumerate(config):
+            env["GIT_CONFIG_KEY_{}".format(i)] = key
+            env["GIT_CONFIG_VALUE_{}".format(i)] = value
+        env["GIT_TERMINAL_PROMPT"] = "0"
+        return env
+
+    def update(self):
+        """Create the mirror or fetch new commits, branches and tags.
+        The mirror is locked meanwhile, so processes sharing the mirror directory do not interfere."""
+        url = "https://github.wdf.sap.corp/{}.git".format(self.repo)
+        with file_lock(self.path):
+            if not os.path.isdir(self.path):
+                log.info("creating git mirror of %s in %s", self.repo, self.path)
+                if run_logged(["git", "init", "--bare", "--quiet", self.path], log_stdout=git_log, log_stderr=git_log) != 0:
+                    raise RuntimeError("creating git mirror in {} failed".format(self.path))
+            else:
+                log.info("updating git mirror of %s", self.repo)
+            cmd = ["git", "--git-dir", self.path, "fetch", "--prune", "--quiet", url,
+                   "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+            with telemetry.measure("git-fetch") as m:
+                returncode = run_logged(cmd, log_stdout=git_log, log_stderr=git_log, env=self.git_env())
+                m.error = returncode != 0
+        if returncode != 0:
+            raise RuntimeError("fetching {} into {} failed".format(url, self.path))
+
+    def lookup(self, name):
+        """Look up a git object by name, e.g. '<ref>:<path>'. Returns (id, type, data), or None if it does not exist."""
+        with self.lock:
+            if not self.updated:
+                self.update()
+                self.updated = True
+            if self.proc is None:
+                self.proc = subprocess.Popen(["git", "--git-dir", self.path, "cat-file", "--batch"],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.proc.stdin.write((name + "\n").encode("UTF-8"))
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().decode("UTF-8").split()
+            if len(header) != 3:  # e.g. "<name> missing"
+                return None
+            object_id, kind, size = header
+            data = self.proc.stdout.read(int(size))
+            self.proc.stdout.read(1)  # trailing newline
+        return object_id, kind, data
+
+    def read(self, ref, path):
+        """Return the content of a file at the given ref, or None if it does not exist."""
+        obj = self.lookup("{}:{}".format(ref, path))
+        if not obj or obj[1] != "blob":
+            return None
+        return obj[2].decode("UTF-8")
+
+    def resolve(self, ref):
+        """Return the commit id of a ref, or None if it does not exist."""
+        obj = self.lookup(ref + "^{commit}")
+        return obj[0] if obj else None
+
+    def close(self):
+        with self.lock:
+            if self.proc:
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
+
+
+_git_mirrors = {}
+_git_mirrors_lock = threading.Lock()
+
+
+def get_git_mirror(repo):
+    """Return the local git mirror of a repository."""
+    with _git_mirrors_lock:
+        if repo not in _git_mirrors:
+            _git_mirrors[repo] = GitMirror(repo)
+            atexit.register(_git_mirrors[repo].close)
+        return _git_mirrors[repo]
+
+#### Resolving git refs ####################################################
+
+_resolved_refs = {}
+_resolved_refs_lock = threading.Lock()
+
+
+def is_commit_id(ref):
+    return re.match(r"^[0-9a-f]{40}$", ref) is not None
+
+
+def resolve_ref(repo, ref):
+    """Return the commit id a ref (branch, tag or commit id) of a repository points to, or None if the ref
+    does not exist. Each ref is resolved only once per process, so all fetches of a run pinned to the
+    resolved commit see the same content, even if a branch moves in the meantime.
+    If the ref cannot be resolved due to other errors, it is returned unchanged."""
+    if is_commit_id(ref):
+        return ref
+    with _resolved_refs_lock:
+        if (repo, ref) in _resolved_refs:
+            return _resolved_refs[(repo, ref)]
+    if FETCH_BACKEND == "git":
+        commit = get_git_mirror(repo).resolve(ref)
+    else:
+        commit = fetch_commit_id(repo, ref)
+    log.debug("resolved %s:%s to %s", repo, ref, commit)
+    with _resolved_refs_lock:
+        return _resolved_refs.setdefault((repo, ref), commit)
+
+
+def fetch_commit_id(repo, ref):
+    """Get the commit id of a ref from the corporate GitHub API, or None if the ref does not exist."""
+    url = "https://github.wdf.sap.corp/api/v3/repos/{}/commits/{}".format(repo, ref)
+    try:
+        content = get_file_from(url, auth=get_github_auth(), headers={"Accept": "application/vnd.github.sha"})
+    except requests.exceptions.HTTPError as ex:
+        if ex.response is not None and ex.response.status_code == 422:  # not a valid ref
+            return None
+        log.warning("cannot resolve %s:%s, using unpinned ref: %s", repo, ref, ex)
+        return ref
+    if content == 404:
+        return None
+    if not isinstance(content, str) or not is_commit_id(content.strip()):
+        log.warning("cannot resolve %s:%s, using unpinned ref", repo, ref)
+        return ref
+    return content.strip()
+
+
+def ref_exists(repo, ref):
+    """Find out whether a ref (branch, tag or commit id) exists in a repository."""
+    return resolve_ref(repo, ref) is not None
+
+#### Coordinating concurrent jobs ##########################################
+
+
+# Lock files of file_lock, shared by all jobs of the same user on a machine
+LOCK_DIR = os.getenv("UPGRADE_VALIDATION_LOCK_DIR", os.path.join(os.path.expanduser("~"), ".cache", "upgrade-validation", "locks"))
+
+# File recording the include/exclude patterns a directory has been downloaded with (see is_downloaded)
+DOWNLOAD_FILTER_FILE = ".download-filter"
+
+
+@contextlib.contextmanager
+def file_lock(path, log_wait=log.info):
+    """Hold an exclusive lock for path while executing the enclosed block.
+    The lock is shared between threads and processes, so concurrent jobs in the same workspace wait for
+    a download or unpacking in progress instead of duplicating it. Waiting is logged with log_wait.
+    The lock files are kept in LOCK_DIR, named after the absolute path."""
+    abspath = os.path.abspath(path.rstrip("/"))
+    lock_file = os.path.join(LOCK_DIR, "{}-{}.lock".format(
+        os.path.basename(abspath), hashlib.sha256(abspath.encode("UTF-8")).hexdigest()[:16]))
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(lock_file, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log_wait("waiting for %s, which is being prepared by another job", path)
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def make_temp_dir(outdir):
+    """Create a temporary directory next to outdir, which can be renamed to outdir atomically."""
+    parent = os.path.dirname(outdir.rstrip("/")) or "."
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix="." + os.path.basename(outdir.rstrip("/")) + ".", dir=parent)
+    os.chmod(tmpdir, 0o755)
+    return tmpdir
+
+
+@contextlib.contextmanager
+def temp_dir_for(outdir):
+    """Create a temporary directory next to outdir (see make_temp_dir) for the enclosed block.
+    The directory is removed at the end of the block, unless it has been renamed to outdir."""
+    tmpdir = make_temp_dir(outdir)
+    try:
+        yield tmpdir
+    finally:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def get_download_filter(include, exclude):
+    """Return the record of include/exclude patterns stored in DOWNLOAD_FILTER_FILE, or None if all files are downloaded."""
+    if include is None and exclude is None:
+        return None
+    return json.dumps({"include": include, "exclude": exclude}, sort_keys=True)
+
+
+def is_downloaded(outdir, download_filter):
+    """Find out whether outdir contains a download with the given filter (see get_download_filter).
+    A directory without DOWNLOAD_FILTER_FILE is a full download or a local copy placed there by the user,
+    so it is used for any filter and never removed. A directory which has been downloaded by this module
+    with a different filter is removed, so that it is downloaded again. Call with file_lock(outdir) held."""
+    if not os.path.isdir(outdir):
+        return False
+    try:
+        with open(os.path.join(outdir, DOWNLOAD_FILTER_FILE)) as f:
+            current = f.read()
+    except OSError:
+        return True
+    if current == download_filter:
+        return True
+    log.info("removing %s, which has been downloaded with other include/exclude patterns", outdir)
+    with temp_dir_for(outdir) as tmpdir:
+        os.rename(outdir, os.path.join(tmpdir, "old"))
+    return False
+
+
+def set_download_filter(outdir, download_filter):
+    """Record the include/exclude patterns of a download in outdir (see is_downloaded)."""
+    if download_filter is not None:
+        with open(os.path.join(outdir, DOWNLOAD_FILTER_FILE), "w") as f:
+            f.write(download_filter)
+
 #### Fetching remote files #################################################
 
 
 ARTIFACTORY_URL = "https://int.repositories.cloud.sap/artifactory/build-milestones/"
 
+# Suffixes of artifact packages in Artifactory, in order of preference
+ARTIFACT_SUFFIXES = [".zip", ".tar.gz", "-linuxx86_64.zip", "-linuxx86_64.tar.gz"]
+
+# Files skipped when extracting selected files from repository archives (see download_repo_from_github)
+ARCHIVE_EXCLUDES = ["vendor/*", "*/vendor/*", ".yarn/*", "*/.yarn/*", "node_modules/*", "*/node_modules/*",
+                    "test/*", "*/test/*", "tests/*", "*/tests/*"]
+
+# Number of files fetched concurrently by get_many_from_github()
+FETCH_WORKERS = int(os.getenv("UPGRADE_VALIDATION_FETCH_WORKERS", 16))
+
 
 def get_github_token():
     return os.getenv("UPGRADE_VALIDATION_GITHUB_TOKEN")
 
 
+def get_github_auth():
+    """Return credentials for corporate GitHub, or None for anonymous access."""
+    github_token = get_github_token()
+    if github_token:
+        return requests.auth.HTTPBasicAuth("di-upgrade-validation-bot", github_token)
+    log.warning("GitHub token not found. Using anonymous access!")
+    return None
+
+
 def read_from_url_or_file(url):
     """Return contents of the given URL / file."""
     if url.find("://") != -1:
-        # this looks like an URL, so get it with curl
-        curl_cmd = ['curl', "-sk", url, "--retry", str(12)]
-        if 'github.wdf.sap.corp' in url:
-            github_token = get_github_token()
-            if github_token:
-                curl_cmd.extend(["-u", "di-upgrade-validation-bot:" + github_token])
-            else:
-                log.warning("GitHub token not found. Using anonymous access!")
-        proc = subprocess.Popen(curl_cmd, stdout=subprocess.PIPE)
-        output = proc.stdout.read().decode("UTF-8")
+        cache = get_fetch_cache()
+        if cache:
+            output = cache.get(url)
+            telemetry.get_registry().cache(telemetry.classify_url(url), output is not None)
+            if output is not None:
+                log.debug("using cached copy of %s", url)
+                return output
+        # this looks like an URL, so fetch it using the shared HTTP session
+        auth = get_github_auth() if 'github.wdf.sap.corp' in url else None
+        try:
+            output = get_file_from(url, auth=auth)
+        except requests.exceptions.HTTPError as ex:
+            log.error("Download failed: %s", ex)
+            output = None
+        if not isinstance(output, str):
+            return ""
+        if cache:
+            cache.put(output, is_immutable_url(url), url)
     else:
         # regular file, just read it
-        output = open(url).read()
+        with telemetry.measure("file") as m:
+            output = open(url).read()
+            m.bytes = len(output)
     return output
 
 
-def get_file_from(url, retries=12, auth=None):
-    """Download the content from the given url, with optional retries.
-    Returns None when the file cannot be downloaded."""
-    log.getLogger("requests").setLevel(log.ERROR)  # turn off INFO/DEBUG messages from the requests package
-    for i in range(1, retries + 1):
+def get_response(url, retries=12, auth=None, headers=None):
+    """Send a GET request with optional retries (see RetryPolicy) and return the response.
+    Returns None when no response was received, or only responses which are worth retrying."""
+    policy = get_retry_policy()
+    for attempt in policy.attempts(url, retries):
         try:
-            req = requests.get(url, verify=False, allow_redirects=True, auth=auth)
-            break  # finish if nothing goes wrong
-            log.debug("retrying %s", url)
-        except requests.exceptions.ConnectionError as e1:
-            log.error(e1, exc_info=True)
-            if i == retries:
-                print("exceeded maximum number of connection error retries (%d)", retries)
-                return req.status_code
-        except requests.exceptions.Timeout as e2:
-            log.error(e2, exc_info=True)
-            if i == retries:
-                print("exceeded maximum number of timeout error retries (%d)", retries)
-                return req.status_code
-        time.sleep(10)
-    if req.status_code == 404:
-        log.error("Download failed: %s not found", url)
-        return req.status_code
-    req.raise_for_status()
+            req = httpclient.get(url, auth=auth, headers=headers)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+            log.warning("attempt %d to fetch %s failed: %s", attempt, url, ex)
+            policy.failure(url)
+            continue
+        if httpclient.is_rate_limited(req):
+            log.warning("attempt %d to fetch %s was rate limited", attempt, url)
+            continue
+        if req.status_code in httpclient.RETRY_STATUS:
+            log.warning("attempt %d to fetch %s failed with status %d", attempt, url, req.status_code)
+            policy.failure(url)
+            continue
+        policy.success(url)
+        return req
+    log.error("cannot fetch %s", url)
+    return None
+
+
+def get_file_from(url, retries=12, auth=None, headers=None):
+    """Download the content from the given url, with optional retries (see RetryPolicy).
+    Returns None when the file cannot be downloaded."""
+    with telemetry.measure(telemetry.classify_url(url)) as m:
+        req = get_response(url, retries, auth, headers)
+        if req is None:
+            m.error = True
+            return None
+        m.bytes = len(req.content)
+        if req.status_code == 404:
+            m.error = True
+            log.error("Download failed: %s not found", url)
+            return req.status_code
+        req.raise_for_status()
+        return req.text
+
+
+def read_revalidated(url):
+    """Return the content of a URL which changes rarely, e.g. a file on a branch.
+    A copy is kept in the fetch cache together with its ETag and Last-Modified headers, and revalidated
+    with a conditional GET, so the content is only downloaded again if it has changed.
+    Returns None when the URL cannot be fetched and no copy is cached."""
+    cache = get_fetch_cache()
+    cached = json.loads(cache.get("revalidated", url) or "null") if cache else None
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    auth = get_github_auth() if 'github.wdf.sap.corp' in url else None
+    with telemetry.measure(telemetry.classify_url(url)) as m:
+        req = get_response(url, auth=auth, headers=headers or None)
+        if req is not None and req.status_code == 304 and cached:
+            log.debug("cached copy of %s is still valid", url)
+            return cached["content"]
+        if req is None or req.status_code != 200:
+            m.error = True
+            if cached:
+                log.warning("cannot revalidate %s, using cached copy", url)
+                return cached["content"]
+            if req is not None:
+                log.error("Download failed: %s returned status %d", url, req.status_code)
+            return None
+        m.bytes = len(req.content)
+    if cache:
+        entry = {"etag": req.headers.get("ETag"), "last_modified": req.headers.get("Last-Modified"), "content": req.text}
+        cache.put(json.dumps(entry), True, "revalidated", url)
     return req.text
 
 
 def request_file_from(url, filename, retries=12):
     """Downloads the file from the given url and saves it to filename, with optional retries"""
-    text = get_file_from(url, filename, retries)
-    if text == None:
+    text = get_file_from(url, retries=retries)
+    if not isinstance(text, str):
         return False
     # write the result to a file
     with open(filename, 'w') as f:
@@ -173,58 +769,154 @@ def get_from_github_or_local(repo, path, version, **kwargs):
         return get_from_github(repo, path, version, not_found_ok=True)
 
 
-def download_repo_from_github(repo, branch, remove_archive=False, outdir=None):
-    """Download a repo from corporate github and put it into a matching dir."""
+def download_repo_from_github(repo, branch, remove_archive=False, outdir=None, include=None, exclude=None):
+    """Download a repo from corporate github and put it into a matching dir.
+    If include or exclude patterns are given, the repository archive is streamed and only files
+    matching include (default: all) and not matching exclude (default: ARCHIVE_EXCLUDES) are extracted.
+    Patterns are globs matched against the path of a file within the repository, e.g. 'operators/*'."""
     if not outdir:
         outdir = os.path.join("repos", repo)
-    zipfile = "{}-{}.zip".format(outdir.replace('/', '-'), branch)
+    archive_file = "{}-{}.zip".format(outdir.replace('/', '-'), branch)
     url = "https://github.wdf.sap.corp/{}/archive/{}.zip".format(repo, branch)
-    if os.path.isdir(outdir):
-        log.debug("repository %s is already present, skipping download", repo)
-        return outdir
+    if include is not None or exclude is not None:
+        include = include or ["*"]
+        exclude = ARCHIVE_EXCLUDES if exclude is None else exclude
+    download_filter = get_download_filter(include, exclude)
 
-    dbg = open(os.devnull, 'wb')
+    with file_lock(outdir):
+        if is_downloaded(outdir, download_filter):
+            log.debug("repository %s is already present, skipping download", repo)
+            return outdir
 
-    # download an archive from github
-    if not os.path.isfile(zipfile):
-        log.info("downloading repository %s from %s", repo, url)
-        curl_cmd = ["curl", "-Lfk", url, "-o", zipfile, "--retry", str(12)]
-        github_token = get_github_token()
-        if github_token:
-            curl_cmd.extend(["-u", "di-upgrade-validation-bot:" + github_token])
-        else:
-            log.warning("GitHub token not found. Using anonymous access!")
-        if subprocess.call(curl_cmd, stderr=dbg) != 0:
-            log.fatal("Error fetching branch %s from github: %s", branch, url)
-            sys.exit(-1)
+        if download_filter is not None:
+            return stream_repo_from_github(repo, branch, outdir, include, exclude)
 
-    # unzip it into outdir
-    log.info("unpacking repository %s to %s", repo, outdir)
-    cmd = ["ditto", "-xk", zipfile, "tmp"] if platform.system() == "Darwin" else ["unzip", zipfile, "-d", "tmp"]
-    if subprocess.call(cmd, stdout=dbg) != 0:
-        log.fatal("error unpacking %s", zipfile)
-        sys.exit(-1)
-    os.makedirs(outdir)
-    os.rename("tmp/" + repo.split('/')[1] + "-" + branch, outdir)
+        # download an archive from github
+        if not os.path.isfile(archive_file):
+            log.info("downloading repository %s from %s", repo, url)
+            if not httpclient.download(url, archive_file, auth=get_github_auth()):
+                log.fatal("Error fetching branch %s from github: %s", branch, url)
+                sys.exit(-1)
 
-    # remove archive file, if desired
-    if remove_archive:
-        os.remove(zipfile)
+        # unzip it next to outdir and move its top-level directory into place
+        log.info("unpacking repository %s to %s", repo, outdir)
+        with temp_dir_for(outdir) as tmpdir:
+            extract_archive(archive_file, tmpdir)
+            entries = os.listdir(tmpdir)
+            if len(entries) != 1:
+                log.fatal("unexpected content in archive %s: %s", archive_file, entries)
+                sys.exit(-1)
+            os.rename(os.path.join(tmpdir, entries[0]), outdir)
+
+        # remove archive file, if desired
+        if remove_archive:
+            os.remove(archive_file)
     return outdir
 
 
+# Errors of a streamed archive download after which the download is retried
+STREAM_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, ConnectionError,
+                 tarfile.TarError, EOFError, zlib.error)
+
+
+def stream_repo_from_github(repo, branch, outdir, include, exclude, retries=12):
+    """Stream the tarball of a repo from corporate github and extract the selected files into outdir,
+    without storing the archive. See download_repo_from_github for the include and exclude patterns.
+    Failed downloads are retried (see RetryPolicy), each attempt starting in a fresh directory."""
+    url = "https://github.wdf.sap.corp/{}/archive/{}.tar.gz".format(repo, branch)
+    policy = get_retry_policy()
+
+    for attempt in policy.attempts(url, retries):
+        log.info("streaming repository %s from %s", repo, url)
+        with temp_dir_for(outdir) as tmpdir:
+            try:
+                with telemetry.measure("github-archive") as m, httpclient.host_slot(url), \
+                        httpclient.get(url, auth=get_github_auth(), stream=True) as resp:
+                    if httpclient.is_rate_limited(resp):
+                        log.warning("attempt %d to stream %s was rate limited", attempt, url)
+                        m.error = True
+                        continue
+                    if resp.status_code in httpclient.RETRY_STATUS:
+                        log.warning("attempt %d to stream %s failed with status %d", attempt, url, resp.status_code)
+                        m.error = True
+                        policy.failure(url)
+                        continue
+                    if resp.status_code != 200:
+                        log.fatal("Error fetching branch %s from github: %s (status %d)", branch, url, resp.status_code)
+                        sys.exit(-1)
+                    resp.raw.decode_content = True
+                    count = extract_tar_stream(resp.raw, tmpdir, include, exclude, url)
+                    m.bytes = resp.raw.tell() if hasattr(resp.raw, "tell") else 0
+            except STREAM_ERRORS as ex:
+                log.warning("attempt %d to stream %s failed: %s", attempt, url, ex)
+                policy.failure(url)
+                continue
+            policy.success(url)
+
+            log.info("extracted %d files of repository %s to %s", count, repo, outdir)
+            set_download_filter(tmpdir, get_download_filter(include, exclude))
+            os.rename(tmpdir, outdir)
+        return outdir
+
+    log.fatal("Error fetching branch %s from github: %s", branch, url)
+    sys.exit(-1)
+
+
+def extract_tar_stream(fileobj, outdir, include, exclude, url):
+    """Extract the files of a streamed tar.gz repository archive matching include and not exclude into outdir,
+    stripping the top-level directory of the archive. Returns the number of extracted files."""
+    count = 0
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            # strip the top-level directory of the archive, e.g. vflow-master/
+            path = member.name.partition("/")[2]
+            if not member.isfile() or not matches_any(path, include) or matches_any(path, exclude):
+                continue
+            target = os.path.join(outdir, path)
+            if not os.path.abspath(target).startswith(os.path.abspath(outdir) + os.sep):
+                log.warning("skipping %s from %s: path outside of target directory", member.name, url)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with tar.extractfile(member) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            count += 1
+    return count
+
+
 def get_from_github(repo, path, version, not_found_ok):
-    """Fetch a file from corporate GitHub and return it as a string."""
-    url = "https://github.wdf.sap.corp/raw/{}/{}/{}".format(repo, version, path)
-    github_token = get_github_token()
-    auth = None
-    if github_token:
-        auth = requests.auth.HTTPBasicAuth("di-upgrade-validation-bot", github_token)
-    else:
-        log.warning("GitHub token not found. Using anonymous access!")
+    """Fetch a file from corporate GitHub and return it as a string.
+    Depending on FETCH_BACKEND, the file is either downloaded or read from a local git mirror.
+    Branches are pinned to the commit they pointed to when first used (see resolve_ref)."""
+    if not is_immutable_ref(version):
+        commit = resolve_ref(repo, version)
+        if commit is None:
+            if not_found_ok:
+                return False
+            raise Exception("Version {} not found in repository {}".format(version, repo))
+        version = commit
 
-    content = get_file_from(url, auth=auth)
+    if FETCH_BACKEND == "git":
+        with telemetry.measure("git-mirror") as m:
+            content = get_git_mirror(repo).read(version, path)
+            m.bytes = len(content) if content is not None else 0
+        if content is not None:
+            return content
+        elif not_found_ok:
+            return False
+        raise Exception("Error while reading {}:{}/{} from git mirror: not found".format(repo, version, path))
+
+    cache = get_fetch_cache()
+    if cache:
+        content = cache.get(repo, version, path)
+        telemetry.get_registry().cache("github-raw", content is not None)
+        if content is not None:
+            log.debug("using cached copy of %s:%s/%s", repo, version, path)
+            return content
+    url = "https://github.wdf.sap.corp/raw/{}/{}/{}".format(repo, version, path)
+    content = get_file_from(url, auth=get_github_auth())
     if isinstance(content, str):
+        if cache:
+            cache.put(content, is_immutable_ref(version), repo, version, path)
         return content
     elif content == 404 and not_found_ok:
         return False
@@ -232,42 +924,98 @@ def get_from_github(repo, path, version, not_found_ok):
         raise Exception("Error while downloading " + url + ": " + str(content))
 
 
-def download_from_artifactory(group, artifact, version, outdir=None):
-    """Download an artifact from Artifactory and put it in a directory prefixed by prefix."""
+def get_many_from_github(files, workers=FETCH_WORKERS):
+    """Fetch many files from corporate GitHub concurrently. files is a list of (repo, path, version) tuples.
+    Returns a list with one entry per file, in the same order: the content as string, False if the file
+    does not exist, or the exception raised while fetching it."""
+
+    caller = telemetry.get_caller()
+
+    def fetch(file):
+        repo, path, version = file
+        try:
+            with telemetry.called_by(caller):
+                return get_from_github(repo, path, version, not_found_ok=True)
+        except Exception as ex:
+            return ex
+
+    unique_files = list(dict.fromkeys(files))
+    if not unique_files:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(unique_files))) as executor:
+        results = dict(zip(unique_files, executor.map(fetch, unique_files)))
+    return [results[f] for f in files]
+
+
+def download_from_artifactory(group, artifact, version, outdir=None, include=None, exclude=None):
+    """Download an artifact from Artifactory and put it in a directory prefixed by prefix.
+    Optionally, only the files matching include and not matching exclude patterns are unpacked (see Archive.extract)."""
     if not outdir:
         outdir = artifact
     url_base = ARTIFACTORY_URL + group.replace(".", "/") + "/" + artifact + "/" + version + "/"
     url_file = artifact + "-" + version
 
-    log.info("downloading artifact %s:%s from %s", artifact, version, url_base + url_file)
-    success = False
-    dbg = LogStream(log.debug)
-
-    for suffix in [".zip", ".tar.gz", "-linuxx86_64.zip", "-linuxx86_64.tar.gz"]:
-        filename = url_file + suffix
-        if subprocess.call(["curl", "-Lfk", url_base + filename, "-o", filename, "--retry", str(12)], stderr=dbg) == 0:
-            success = True
-            break
-    if not success:
-        log.warning("cannot download package from %s", url_base + filename)
-        return False
+    download_filter = get_download_filter(include, exclude)
 
-    if filename.endswith("tar.gz"):
-        if subprocess.call(["tar", "xzf", filename, "--one-top-level=" + outdir], stderr=dbg) != 0:
-            log.fatal("error unpacking %s", filename)
-            sys.exit(-1)
-    elif filename.endswith(".zip"):
-        if subprocess.call(["unzip", "-o", filename, "-d", outdir], stdout=dbg) != 0:
-            log.fatal("error unpacking %s", filename)
-            sys.exit(-1)
-    else:
-        log.fatal("cannot unpack file %s", filename)
-        sys.exit(-1)
+    with file_lock(outdir):
+        if is_downloaded(outdir, download_filter):
+            log.debug("artifact %s:%s is already present, skipping download", artifact, version)
+            return True
+
+        log.info("downloading artifact %s:%s from %s", artifact, version, url_base + url_file)
+        filenames = [url_file + suffix for suffix in ARTIFACT_SUFFIXES]
+        success = False
+
+        for filename, size in probe_artifact_files(url_base, filenames):
+            if httpclient.download(url_base + filename, filename, size=size):
+                success = True
+                break
+        if not success:
+            log.warning("cannot download package from %s", url_base + url_file)
+            return False
+
+        with temp_dir_for(outdir) as tmpdir:
+            extract_archive(filename, tmpdir, include, exclude)
+            set_download_filter(tmpdir, download_filter)
+            os.rename(tmpdir, outdir)
     return True
 
 
-def unpack_file(filename, outdir, make_subdir=False):
-    """Unpack an archive (zip, tar.gz) into outdir."""
+def probe_artifact_files(url_base, filenames):
+    """Send concurrent HEAD requests to find out which of the given files exist below url_base.
+    Returns (filename, size) for the existing files in the given order. The size is only set if the server
+    supports range requests. Files whose existence cannot be determined are included with unknown size,
+    after the files that are known to exist."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(filenames)) as executor:
+        responses = list(executor.map(telemetry.with_caller(lambda f: httpclient.head(url_base + f)), filenames))
+
+    found, unknown = [], []
+    for filename, resp in zip(filenames, responses):
+        if resp is None or resp.status_code not in (200, 404, 410):
+            unknown.append((filename, None))
+        elif resp.status_code == 200:
+            size = None
+            if resp.headers.get("Accept-Ranges") == "bytes" and resp.headers.get("Content-Length", "").isdigit():
+                size = int(resp.headers["Content-Length"])
+            found.append((filename, size))
+    return found + unknown
+
+
+def extract_archive(filename, outdir, include=None, exclude=None):
+    """Extract the files of an archive (zip, tar.gz) matching include and not matching exclude into outdir."""
+    try:
+        with telemetry.measure("unpack") as m, Archive(filename) as archive:
+            count = archive.extract(outdir, include, exclude)
+            m.bytes = os.path.getsize(filename)
+    except (OSError, ValueError, tarfile.TarError, zipfile.BadZipFile) as ex:
+        log.fatal("error unpacking %s: %s", filename, ex)
+        sys.exit(-1)
+    log.debug("unpacked %d files from %s", count, filename)
+
+
+def unpack_file(filename, outdir, make_subdir=False, include=None, exclude=None):
+    """Unpack an archive (zip, tar.gz) into outdir.
+    Optionally, only the files matching include and not matching exclude patterns are unpacked (see Archive.extract)."""
     # Optionally, create a subdirectory from the given filename.
     if make_subdir:
         if filename.endswith(".tar.gz"):
@@ -276,24 +1024,16 @@ def unpack_file(filename, outdir, make_subdir=False):
             outdir += "/" + filename[:-4]
 
     # No need to unpack if the directory already exists
-    if os.path.isdir(outdir):
-        log.debug("directory %s already exists, skip unpacking", outdir)
-        return outdir
-
-    log.info("unpacking %s to %s", filename, outdir)
-    dbg = LogStream(log.debug)
-    if filename.endswith("tar.gz"):
-        if subprocess.call(["tar", "xzf", filename, "--one-top-level=" + outdir], stderr=dbg) != 0:
-            log.fatal("error unpacking %s", filename)
-            sys.exit(-1)
-    elif filename.endswith(".zip"):
-        if subprocess.call(["unzip", "-o", filename, "-d", outdir], stdout=dbg) != 0:
-            log.fatal("error unpacking %s", filename)
-            sys.exit(-1)
-    else:
-        log.fatal("cannot unpack file %s", filename)
-        sys.exit(-1)
-
+    download_filter = get_download_filter(include, exclude)
+    with file_lock(outdir):
+        if is_downloaded(outdir, download_filter):
+            log.debug("directory %s already exists, skip unpacking", outdir)
+            return outdir
+        log.info("unpacking %s to %s", filename, outdir)
+        with temp_dir_for(outdir) as tmpdir:
+            extract_archive(filename, tmpdir, include, exclude)
+            set_download_filter(tmpdir, download_filter)
+            os.rename(tmpdir, outdir)
     return outdir
 
 
@@ -0,0 +1,504 @@
+import atexit
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging as log
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+import requests
+import requests.adapters
+import urllib3
+urllib3.disable_warnings()
+
+from pylibs import telemetry
+
+# Number of hosts to keep connection pools for, and connections kept alive per host.
+POOL_HOSTS = 16
+POOL_CONNECTIONS_PER_HOST = 16
+
+# Maximum number of concurrent requests per host
+MAX_REQUESTS_PER_HOST = int(os.getenv("UPGRADE_VALIDATION_MAX_REQUESTS_PER_HOST", 8))
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (30, 120)
+
+# Chunk size for streaming downloads to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Files of at least this size (in bytes) are downloaded in parallel byte ranges, if the server supports it.
+# 0 disables parallel downloads.
+PARALLEL_DOWNLOAD_MIN_BYTES = int(os.getenv("UPGRADE_VALIDATION_PARALLEL_DOWNLOAD_MIN_BYTES", 256 * 1024 * 1024))
+PARALLEL_DOWNLOAD_PARTS = 4
+
+# Retries of failed requests: the delay grows exponentially from RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds,
+# the time spent waiting for retries is limited to RETRY_BUDGET seconds per run, and hosts failing
+# BREAKER_THRESHOLD times in a row are not contacted for BREAKER_COOLDOWN seconds.
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRY_BUDGET = int(os.getenv("UPGRADE_VALIDATION_RETRY_BUDGET", 600))
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 120
+
+# Status codes of responses worth retrying
+RETRY_STATUS = (502, 503, 504)
+
+# Requests per second and burst size of the token bucket limiting the requests to each host (0: no limit).
+# The buckets are shared by all processes using the same RATE_LIMIT_DIR (empty: per process only).
+# Only the hosts in RATE_LIMIT_HOSTS (comma-separated, "*": all hosts) are limited, by default GitHub.
+RATE_LIMIT = float(os.getenv("UPGRADE_VALIDATION_RATE_LIMIT", 10))
+RATE_BURST = 20
+RATE_LIMIT_HOSTS = os.getenv("UPGRADE_VALIDATION_RATE_LIMIT_HOSTS", "github.wdf.sap.corp").split(",")
+RATE_LIMIT_DIR = os.getenv("UPGRADE_VALIDATION_RATE_LIMIT_DIR", os.path.expanduser("~/.cache/upgrade-validation/ratelimit"))
+
+# Record all responses of a run into a bundle file, or replay them from a bundle without network access.
+RECORD_BUNDLE = os.getenv("UPGRADE_VALIDATION_RECORD")
+REPLAY_BUNDLE = os.getenv("UPGRADE_VALIDATION_REPLAY")
+
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+_bundle = None
+_retry_policy = None
+_rate_limiter = None
+
+
+class ReplayError(RuntimeError):
+    pass
+
+
+class RetryPolicy():
+    """Decides whether and when a failed request is retried.
+    Delays grow exponentially with random jitter, so that concurrent jobs do not retry in lockstep. The time
+    spent waiting for retries is limited by a budget for the whole run, and a host failing repeatedly is
+    given up on immediately for a while (circuit breaker), so a degraded host cannot stall a job."""
+
+    def __init__(self, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, budget=RETRY_BUDGET,
+                 threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.spent = 0.0
+        self.failures = {}  # host -> number of consecutive failures
+        self.opened = {}  # host -> time when the circuit was opened
+
+    def attempts(self, url, retries):
+        """Yield the numbers of the (at most retries) attempts to make for url, waiting before each retry.
+        Stops early if the retry budget is exhausted or the circuit for the host is open."""
+        host = get_host(url)
+        for attempt in range(1, retries + 1):
+            if self.is_open(host):
+                log.error("giving up on %s: %s failed %d times in a row", url, host, self.failures.get(host, 0))
+                return
+            if attempt > 1:
+                delay = self.reserve(self.delay(attempt - 1))
+                if delay is None:
+                    log.error("giving up on %s: retry budget of %ds exhausted", url, self.budget)
+                    return
+                log.debug("retrying %s in %.1fs", url, delay)
+                telemetry.get_registry().add(telemetry.classify_url(url), retries=1)
+                time.sleep(delay)
+            yield attempt
+
+    def delay(self, retry):
+        """Return the delay before the given retry: the exponential backoff, half of it randomized."""
+        backoff = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def reserve(self, delay):
+        """Take delay from the retry budget. Returns None if the budget is exhausted."""
+        with self.lock:
+            if self.spent + delay > self.budget:
+                return None
+            self.spent += delay
+            return delay
+
+    def is_open(self, host):
+        """Find out whether requests to host should fail fast. After the cooldown, requests are let through
+        again; the circuit is closed by the next success or opened again by the next failure."""
+        with self.lock:
+            opened = self.opened.get(host)
+            return opened is not None and time.monotonic() - opened < self.cooldown
+
+    def success(self, url):
+        host = get_host(url)
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, url):
+        host = get_host(url)
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.threshold:
+                if host not in self.opened:
+                    log.warning("%s failed %d times in a row, pausing requests for %ds", host, self.failures[host], self.cooldown)
+                self.opened[host] = time.monotonic()
+
+
+class RateLimiter():
+    """Token buckets limiting the rate of requests per host, shared by all threads and (if state_dir is set)
+    all processes of the same user. Rate-limit headers of responses (Retry-After, X-RateLimit-Remaining and
+    X-RateLimit-Reset, as sent by GitHub) slow down or pause further requests to the host, so that concurrent
+    runs spread their requests over the rate-limit window instead of running into 403/429 errors.
+    Requests to hosts not in hosts are not limited."""
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, state_dir=RATE_LIMIT_DIR, hosts=RATE_LIMIT_HOSTS):
+        self.rate = rate
+        self.burst = burst
+        self.hosts = {host.strip() for host in hosts if host.strip()}
+        self.state_dir = state_dir
+        self.lock = threading.Lock()
+        self.states = {}
+        if state_dir:
+            try:
+                os.makedirs(state_dir, exist_ok=True)
+            except OSError as ex:
+                log.warning("cannot share rate limits between processes: %s", ex)
+                self.state_dir = None
+
+    @contextlib.contextmanager
+    def state(self, host):
+        """Yield the state of the bucket of host for reading and updating it, holding a lock."""
+        if not self.state_dir:
+            with self.lock:
+                yield self.states.setdefault(host, {})
+            return
+        with open(os.path.join(self.state_dir, host), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def is_limited(self, url):
+        """Find out whether requests to the host of url are limited."""
+        return bool(self.rate) and ("*" in self.hosts or get_host(url) in self.hosts)
+
+    def acquire(self, url):
+        """Take a token from the bucket of the host of url, waiting until it is available."""
+        if not self.is_limited(url):
+            return
+        now = time.time()
+        with self.state(get_host(url)) as state:
+            rate = state.get("rate", self.rate) if state.get("rate_until", 0) > now else self.rate
+            tokens = min(self.burst, state.get("tokens", self.burst) + (now - state.get("time", now)) * rate)
+            state["tokens"] = tokens - 1  # reserve a token, even if this means waiting for it
+            state["time"] = now
+            wait = max(-state["tokens"] / rate, state.get("blocked_until", 0) - now)
+        if wait > 0:
+            log.debug("waiting %.1fs for rate limit of %s", wait, get_host(url))
+            time.sleep(wait)
+
+    def update(self, url, resp):
+        """Adapt the rate for the host of url to the rate-limit headers of a response."""
+        if not self.is_limited(url):
+            return
+        headers = resp.headers
+        retry_after = headers.get("Retry-After", "")
+        remaining = headers.get("X-RateLimit-Remaining", "")
+        reset = headers.get("X-RateLimit-Reset", "")
+        if not (retry_after.isdigit() or (remaining.isdigit() and reset.isdigit())):
+            return
+        now = time.time()
+        with self.state(get_host(url)) as state:
+            if retry_after.isdigit() and resp.status_code in (403, 429, 503):
+                state["blocked_until"] = max(state.get("blocked_until", 0), now + int(retry_after))
+            elif remaining.isdigit() and reset.isdigit() and int(reset) > now:
+                if int(remaining) == 0:
+                    state["blocked_until"] = max(state.get("blocked_until", 0), int(reset))
+                else:
+                    # spread the remaining requests over the rest of the rate-limit window
+                    state["rate"] = min(self.rate, int(remaining) / (int(reset) - now))
+                    state["rate_until"] = int(reset)
+        if state.get("blocked_until", 0) > now:
+            log.warning("rate limit of %s exceeded, pausing requests for %ds", get_host(url), state["blocked_until"] - now)
+
+
+def get_rate_limiter():
+    """Return the rate limiter shared by all requests of this run."""
+    global _rate_limiter
+    with _session_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+
+def is_rate_limited(resp):
+    """Find out whether a request was rejected due to a rate limit, i.e. is worth retrying later."""
+    return resp.status_code == 429 or (resp.status_code == 403 and (
+        resp.headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in resp.headers))
+
+
+def get_retry_policy():
+    """Return the retry policy shared by all requests of this run."""
+    global _retry_policy
+    with _session_lock:
+        if _retry_policy is None:
+            _retry_policy = RetryPolicy()
+    return _retry_policy
+
+
+class ResponseBody():
+    """File-like response body of a recorded or replayed response."""
+    decode_content = True
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1, **kwargs):
+        return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+
+
+def make_response(url, status, reason, encoding, body):
+    """Create a response object for a recorded or replayed response."""
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = status
+    resp.reason = reason
+    resp.encoding = encoding
+    resp.raw = ResponseBody(body)
+    return resp
+
+
+class Bundle():
+    """Single file (zip) holding HTTP responses, indexed by URL.
+    In mode 'w', all responses of a run are recorded. In mode 'r', responses are replayed from the bundle,
+    so that a run can be repeated without network access."""
+
+    def __init__(self, filename, mode):
+        self.filename = filename
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.zip = zipfile.ZipFile(filename, mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.index = json.loads(self.zip.read("index.json")) if mode == "r" else {}
+
+    def record(self, url, resp):
+        """Store a response and return an equivalent response that can still be read by the caller."""
+        body = tempfile.TemporaryFile()
+        with resp:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                body.write(chunk)
+        with self.lock:
+            if url not in self.index:
+                name = "responses/" + hashlib.sha256(url.encode("UTF-8")).hexdigest()
+                body.seek(0)
+                with self.zip.open(name, "w", force_zip64=True) as f:
+                    shutil.copyfileobj(body, f)
+                self.index[url] = {"name": name, "status": resp.status_code, "reason": resp.reason, "encoding": resp.encoding}
+        body.seek(0)
+        return make_response(url, resp.status_code, resp.reason, resp.encoding, body)
+
+    def replay(self, url):
+        """Return the recorded response for a URL."""
+        entry = self.index.get(url)
+        if not entry:
+            raise ReplayError("{} not found in replay bundle {}".format(url, self.filename))
+        return make_response(url, entry["status"], entry["reason"], entry["encoding"], self.zip.open(entry["name"]))
+
+    def close(self):
+        with self.lock:
+            if self.mode == "w":
+                self.zip.writestr("index.json", json.dumps(self.index, indent=1))
+                log.info("recorded %d responses in %s", len(self.index), self.filename)
+            self.zip.close()
+
+
+def get_bundle():
+    """Return the record/replay bundle of this run, or None if neither recording nor replaying."""
+    global _bundle
+    with _session_lock:
+        if _bundle is None and (RECORD_BUNDLE or REPLAY_BUNDLE):
+            if REPLAY_BUNDLE:
+                log.info("replaying responses from %s", REPLAY_BUNDLE)
+                _bundle = Bundle(REPLAY_BUNDLE, "r")
+            else:
+                log.info("recording responses to %s", RECORD_BUNDLE)
+                _bundle = Bundle(RECORD_BUNDLE, "w")
+            atexit.register(_bundle.close)
+    return _bundle
+
+
+def get_session():
+    """Return the process-wide HTTP session. Connections are kept alive and pooled per host,
+    responses are transferred gzip-encoded whenever the server supports it."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            log.getLogger("urllib3").setLevel(log.ERROR)  # turn off INFO/DEBUG messages from the connection pool
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_CONNECTIONS_PER_HOST)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            session.verify = False
+            _session = session
+    return _session
+
+
+def get_host(url):
+    return urllib3.util.parse_url(url).host
+
+
+def host_slot(url):
+    """Return a semaphore limiting the number of concurrent requests to the host of url."""
+    host = get_host(url)
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+        return _host_slots[host]
+
+
+def get(url, auth=None, stream=False, headers=None):
+    """Send a GET request using the shared session and return the response.
+    With stream=True, the body is only read when accessed, e.g. via iter_content(). In this case
+    the caller should hold host_slot(url) until the body has been consumed.
+    When recording or replaying (see Bundle), responses are stored in or served from the bundle."""
+    bundle = get_bundle()
+    if bundle and bundle.mode == "r":
+        return bundle.replay(url)
+    get_rate_limiter().acquire(url)
+    if stream:
+        resp = get_session().get(url, auth=auth, headers=headers, stream=True, allow_redirects=True, timeout=TIMEOUT)
+    else:
+        with host_slot(url):
+            resp = get_session().get(url, auth=auth, headers=headers, allow_redirects=True, timeout=TIMEOUT)
+    get_rate_limiter().update(url, resp)
+    if bundle:
+        resp = bundle.record(url, resp)
+    return resp
+
+
+def head(url, auth=None):
+    """Send a HEAD request using the shared session and return the response, or None on connection errors.
+    When replaying, the status of the recorded GET response is returned (404 if the URL was not recorded)."""
+    bundle = get_bundle()
+    if bundle and bundle.mode == "r":
+        entry = bundle.index.get(url)
+        if not entry:
+            return make_response(url, 404, "Not Found", None, None)
+        return make_response(url, entry["status"], entry["reason"], entry["encoding"], None)
+    policy = get_retry_policy()
+    if policy.is_open(get_host(url)):
+        return None
+    with telemetry.measure(telemetry.classify_url(url)) as m:
+        try:
+            get_rate_limiter().acquire(url)
+            with host_slot(url):
+                resp = get_session().head(url, auth=auth, allow_redirects=True, timeout=TIMEOUT)
+            get_rate_limiter().update(url, resp)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+            log.debug("HEAD request for %s failed: %s", url, ex)
+            policy.failure(url)
+            m.error = True
+            return None
+        if resp.status_code in RETRY_STATUS:
+            policy.failure(url)
+        else:
+            policy.success(url)
+        m.error = resp.status_code != 200
+    return resp
+
+
+def download(url, filename, auth=None, retries=12, size=None):
+    """Stream the content of url into filename, with optional retries on connection errors (see RetryPolicy).
+    After a dropped connection, the download is resumed with a Range request instead of restarting.
+    If the size of the file is given (e.g. from a HEAD request with 'Accept-Ranges: bytes') and exceeds
+    PARALLEL_DOWNLOAD_MIN_BYTES, the file is downloaded in PARALLEL_DOWNLOAD_PARTS parallel byte ranges.
+    The file is written under a temporary name and renamed when complete, so it never appears half-written.
+    Returns False if the file cannot be downloaded."""
+    part_file = "{}.part-{}-{}".format(filename, os.getpid(), threading.get_ident())
+    try:
+        with telemetry.measure(telemetry.classify_url(url)) as m:
+            if size and PARALLEL_DOWNLOAD_MIN_BYTES and size >= PARALLEL_DOWNLOAD_MIN_BYTES and not get_bundle():
+                success = download_ranges(url, part_file, size, auth, retries)
+            else:
+                with open(part_file, "wb"):
+                    pass
+                success = download_range(url, part_file, 0, None, auth, retries)
+            m.error = not success
+            if success:
+                m.bytes = os.path.getsize(part_file)
+                os.replace(part_file, filename)
+        return success
+    finally:
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+
+
+def download_ranges(url, filename, size, auth, retries):
+    """Download a file of the given size in parallel byte ranges into filename."""
+    log.debug("downloading %s (%d bytes) in %d parts", url, size, PARALLEL_DOWNLOAD_PARTS)
+    with open(filename, "wb") as f:
+        f.truncate(size)
+    part_size = -(-size // PARALLEL_DOWNLOAD_PARTS)
+    starts = range(0, size, part_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOAD_PARTS) as executor:
+        results = executor.map(lambda start: download_range(url, filename, start, min(start + part_size, size) - 1, auth, retries), starts)
+        return all(list(results))
+
+
+def download_range(url, filename, start, end, auth, retries):
+    """Download the bytes start..end (inclusive, None: until the end) of url into the existing file filename
+    at the same offset. After a dropped connection, the download continues where it stopped."""
+    policy = get_retry_policy()
+    pos = start
+    for attempt in policy.attempts(url, retries):
+        headers = {"Accept-Encoding": "identity"}  # byte offsets must refer to the file itself
+        if pos > 0 or end is not None:
+            headers["Range"] = "bytes={}-{}".format(pos, "" if end is None else end)
+        try:
+            with host_slot(url), get(url, auth=auth, stream=True, headers=headers) as resp:
+                if is_rate_limited(resp):
+                    log.debug("download of %s was rate limited", url)
+                    continue
+                if resp.status_code in RETRY_STATUS:
+                    log.debug("download of %s failed with status %d", url, resp.status_code)
+                    policy.failure(url)
+                    continue
+                policy.success(url)
+                if resp.status_code == 200 and "Range" in headers:
+                    if end is not None:
+                        log.debug("server does not support range requests for %s", url)
+                        return False
+                    log.debug("server does not support resuming %s, restarting download", url)
+                    pos = 0
+                elif resp.status_code not in (200, 206):
+                    log.debug("download of %s failed with status %d", url, resp.status_code)
+                    return False
+                with open(filename, "r+b") as f:
+                    f.seek(pos)
+                    if pos == 0 and end is None:
+                        f.truncate()
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        pos += len(chunk)
+            return True
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as ex:
+            log.debug("download of %s failed at byte %d: %s", url, pos, ex)
+            policy.failure(url)
+    log.error("cannot download %s", url)
+    return False
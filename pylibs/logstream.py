@@ -1,27 +1,108 @@
-import threading
+import logging as log
 import os
+import selectors
+import subprocess
+import threading
 
-class LogStream(threading.Thread):
-    """Provide an interface to redirect stdio/stdin to a logging instance."""
-    def __init__(self, log_level):
-        threading.Thread.__init__(self)
-        self.log_level = log_level
-        self.fd_read, self.fd_write = os.pipe()
-        self.pipe = os.fdopen(self.fd_read)
+_pump = None
+_pump_lock = threading.Lock()
+
+
+class LogPump(threading.Thread):
+    """Forward the output of many pipes (e.g. stdout/stderr of subprocesses) line by line to logging functions,
+    using a single thread which waits for all pipes at once. Each pipe is closed as soon as its writing end
+    has been closed, so no file descriptors are leaked."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="LogPump", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.wake_read, self.wake_write = os.pipe()
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
         self.start()
 
+    def add(self, fd, log_level):
+        """Forward the lines read from fd (a file descriptor or file object) to log_level until EOF.
+        The pump takes ownership of fd. Returns an event which is set when fd has been read completely."""
+        done = threading.Event()
+        with self.lock:
+            self.pending.append((fd, log_level, done))
+        os.write(self.wake_write, b"x")
+        return done
+
     def run(self):
-        for line in iter(self.pipe.readline, ''):
-            self.log_level(line.strip('\n'))
+        while True:
+            for key, _events in self.selector.select():
+                if key.fileobj == self.wake_read:
+                    os.read(self.wake_read, 4096)
+                    with self.lock:
+                        pending, self.pending = self.pending, []
+                    for fd, log_level, done in pending:
+                        self.selector.register(fd, selectors.EVENT_READ, [log_level, done, b""])
+                else:
+                    self.read(key)
+
+    def read(self, key):
+        """Read from a pipe which is ready and forward all complete lines."""
+        log_level, done, partial = key.data
+        fd = key.fileobj if isinstance(key.fileobj, int) else key.fileobj.fileno()
+        data = os.read(fd, 65536)
+        lines = (partial + data).split(b"\n")
+        if data:
+            key.data[2] = lines.pop()
+        for line in lines:
+            if line or data:
+                log_level(line.decode("UTF-8", "replace").rstrip("\r"))
+        if not data:
+            self.selector.unregister(key.fileobj)
+            if isinstance(key.fileobj, int):
+                os.close(key.fileobj)
+            else:
+                key.fileobj.close()
+            done.set()
 
-        self.pipe.close()
+
+def get_log_pump():
+    """Return the log pump shared by all subprocesses of this process."""
+    global _pump
+    with _pump_lock:
+        if _pump is None:
+            _pump = LogPump()
+    return _pump
+
+
+def run_logged(cmd, log_stdout=log.info, log_stderr=log.warning, **kwargs):
+    """Run a command, forwarding its stdout and stderr line by line to the given logging functions.
+    Further arguments are passed to subprocess.Popen. Returns the exit code of the command."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    pump = get_log_pump()
+    done = [pump.add(proc.stdout, log_stdout), pump.add(proc.stderr, log_stderr)]
+    returncode = proc.wait()
+    for d in done:
+        d.wait()
+    return returncode
+
+
+class LogStream():
+    """Provide an interface to redirect stdio/stdin to a logging instance.
+    Pass the LogStream as stdout/stderr to subprocess functions and close it when the subprocess has
+    been started. The output is forwarded by the shared LogPump, so no thread is needed per stream."""
+
+    def __init__(self, log_level):
+        self.log_level = log_level
+        self.fd_read, self.fd_write = os.pipe()
+        self.done = get_log_pump().add(self.fd_read, log_level)
 
     def join(self, timeout=1):
+        """Close the writing end and wait until all output has been logged."""
         self.close()
-        super(LogStream, self).join(timeout)
+        self.done.wait(timeout)
 
     def close(self):
-        os.close(self.fd_write)
+        if self.fd_write is not None:
+            os.close(self.fd_write)
+            self.fd_write = None
 
     def fileno(self):
         return self.fd_write
@@ -0,0 +1,178 @@
+import atexit
+import contextlib
+import json
+import logging as log
+import os
+import sys
+import threading
+import time
+
+# Write the fetch statistics of a run as JSON, or as Prometheus textfile (for the node exporter), at exit.
+TELEMETRY_JSON = os.getenv("UPGRADE_VALIDATION_TELEMETRY_JSON")
+TELEMETRY_PROM = os.getenv("UPGRADE_VALIDATION_TELEMETRY_PROM")
+
+# Counters kept per (kind, caller), with their descriptions for the Prometheus output
+COUNTERS = [
+    ("requests", "Number of fetches"),
+    ("errors", "Number of failed fetches"),
+    ("retries", "Number of retried requests"),
+    ("bytes", "Number of bytes fetched"),
+    ("seconds", "Time spent fetching, in seconds"),
+    ("cache_hits", "Number of fetches served from the local cache"),
+    ("cache_misses", "Number of fetches not found in the local cache"),
+]
+
+# Frames of these files are skipped when determining the caller of a fetch
+INTERNAL_DIRS = (os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.__file__))
+
+_registry = None
+_registry_lock = threading.Lock()
+_local = threading.local()
+
+
+def classify_url(url):
+    """Return the kind of a fetched URL, e.g. 'github-raw' or 'artifactory'."""
+    if "://" not in url:
+        return "file"
+    if "github" in url:
+        if "/raw/" in url:
+            return "github-raw"
+        if "/api/" in url:
+            return "github-api"
+        if "/archive/" in url:
+            return "github-archive"
+        return "github"
+    if url.endswith(".pom") or url.endswith("maven-metadata.xml"):
+        return "pom"
+    if "artifactory" in url:
+        return "artifactory"
+    return "other"
+
+
+def get_caller():
+    """Return 'file:function' of the code outside pylibs (and the standard library) which triggered a fetch."""
+    caller = getattr(_local, "caller", None)
+    if caller:
+        return caller
+    frame = sys._getframe(1)
+    while frame:
+        filename = frame.f_code.co_filename
+        if not os.path.abspath(filename).startswith(INTERNAL_DIRS):
+            return "{}:{}".format(os.path.basename(filename), frame.f_code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+
+@contextlib.contextmanager
+def called_by(caller):
+    """Attribute the fetches in the enclosed block to caller, e.g. in worker threads fetching for another thread."""
+    previous = getattr(_local, "caller", None)
+    _local.caller = caller
+    try:
+        yield
+    finally:
+        _local.caller = previous
+
+
+def with_caller(func):
+    """Return func wrapped to attribute its fetches to the current caller, for running it in worker threads."""
+    caller = get_caller()
+
+    def call(*args, **kwargs):
+        with called_by(caller):
+            return func(*args, **kwargs)
+    return call
+
+
+class Measurement():
+    """Statistics of a single fetch, filled in by the code doing the fetch (see Registry.measure)."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.error = False
+
+
+class Registry():
+    """In-process registry of fetch statistics, aggregated by kind of fetch (see classify_url) and caller."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stats = {}
+
+    def add(self, kind, caller=None, **counts):
+        """Add counts (see COUNTERS) to the statistics of kind and caller."""
+        key = (kind, caller or get_caller())
+        with self.lock:
+            stat = self.stats.setdefault(key, dict.fromkeys([name for name, _ in COUNTERS], 0))
+            for name, value in counts.items():
+                stat[name] += value
+
+    @contextlib.contextmanager
+    def measure(self, kind):
+        """Count a fetch of the given kind and the time spent in the enclosed block. The block can set
+        the number of bytes fetched and whether the fetch failed on the yielded Measurement.
+        Exceptions raised in the block count as errors."""
+        m = Measurement()
+        caller = get_caller()
+        start = time.monotonic()
+        try:
+            yield m
+        except BaseException:
+            m.error = True
+            raise
+        finally:
+            self.add(kind, caller, requests=1, errors=int(m.error), bytes=m.bytes, seconds=time.monotonic() - start)
+
+    def cache(self, kind, hit):
+        """Count a lookup in the local cache."""
+        if hit:
+            self.add(kind, cache_hits=1)
+        else:
+            self.add(kind, cache_misses=1)
+
+    def to_json(self):
+        with self.lock:
+            stats = [dict(kind=kind, caller=caller, **stat) for (kind, caller), stat in sorted(self.stats.items())]
+        return {"started": self.started, "duration": time.time() - self.started, "stats": stats}
+
+    def to_prometheus(self):
+        """Return the statistics in the Prometheus text format."""
+        with self.lock:
+            stats = sorted(self.stats.items())
+        lines = []
+        for name, description in COUNTERS:
+            metric = "upgrade_validation_fetch_{}_total".format(name)
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} counter".format(metric))
+            for (kind, caller), stat in stats:
+                lines.append('{}{{kind="{}",caller="{}"}} {}'.format(metric, kind, caller.replace('"', '\\"'), stat[name]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, json_file=None, prom_file=None):
+        """Write the statistics to the given files. Files are replaced atomically, as required for
+        the textfile collector of the Prometheus node exporter."""
+        for filename, content in [(json_file, lambda: json.dumps(self.to_json(), indent=1)), (prom_file, self.to_prometheus)]:
+            if not filename:
+                continue
+            tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmp_file, "w") as f:
+                f.write(content())
+            os.replace(tmp_file, filename)
+            log.debug("wrote fetch statistics to %s", filename)
+
+
+def get_registry():
+    """Return the fetch statistics of this process."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = Registry()
+            if TELEMETRY_JSON or TELEMETRY_PROM:
+                atexit.register(_registry.dump, TELEMETRY_JSON, TELEMETRY_PROM)
+    return _registry
+
+
+def measure(kind):
+    """Shortcut for get_registry().measure(kind)."""
+    return get_registry().measure(kind)
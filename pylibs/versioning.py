@@ -2,30 +2,130 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import concurrent.futures
+import functools
+import hashlib
 import json
 import logging as log
 import os
 import re
+import sqlite3
 import sys
+import threading
 import yaml
 
 sys.path.append(sys.path[0] + "/../")
-from pylibs.fileops import read_from_url_or_file, read_json_from, read_regex_from, parse_xml, get_from_github
+from pylibs import httpclient, telemetry
+from pylibs.fileops import read_revalidated, read_json_from, read_regex_from, read_pom, get_from_github, get_many_from_github, is_immutable_ref, ref_exists
 
 ARTIFACTORY_URL = "https://int.repositories.cloud.sap/artifactory/build-releases/com/sap/datahub/SAPDataHub/"
 ARTIFACTORY_REL_URL = "https://int.repositories.cloud.sap/artifactory/build-milstones/com/sap/hana/hl/linuxx86_64/"
 VSOLUTION_URL = "https://github.wdf.sap.corp/raw/velocity/vsolution/rel/"
+DIS_VERSIONS_URL = "https://github.wdf.sap.corp/raw/bdh/dis-release/master/dis-versions.yaml"
+
+# Local index of component versions of releases and of cfg/VERSION of tags (empty: no index)
+VERSION_INDEX = os.getenv("UPGRADE_VALIDATION_VERSION_INDEX", os.path.join(os.path.expanduser("~"), ".cache", "upgrade-validation", "versions.sqlite"))
+
+# Search depth for cfg/VERSION in unpacked repositories, and directories which are not searched
+VERSION_FILE_DEPTH = 3
+PRUNED_DIRS = {"node_modules", "vendor", "site-packages", "__pycache__"}
 
 COMPONENTS = ["RELEASEPACK", "VSYSTEM", "HANALITE", "STORAGEGATEWAY", "DIAGNOSTICS",
               "VFLOW", "AXINO", "FLOWAGENT", "CODE_SERVER", "APP_BASE", "APP_DATA",
               "ML_API", "ML_DM_API", "ML_TRACKING", "FEDERATION", "RMS"]
 
 
+VERSION_REGEX = re.compile(r"^([0-9]+)\.([0-9]+)\.([0-9]+)(-ms)?(?:-dis\.([0-9]+))?$")
+
+
+@functools.total_ordering
+class Version():
+    """Parsed version number, e.g. 2.7.8, 2004.1.2, 2010.29.0-ms or 2107.0.1-dis.3.
+    Versions are ordered by their numbers; a milestone (-ms) precedes the corresponding release, and
+    DI Embedded variants (-dis.N) follow it. Use Version.parse() to create instances, which are cached,
+    so each version string is parsed only once."""
+    __slots__ = ("string", "numbers", "milestone", "dis", "key")
+    _cache = {}
+
+    def __init__(self, string, numbers, milestone, dis):
+        self.string = string
+        self.numbers = numbers
+        self.milestone = milestone
+        self.dis = dis
+        self.key = (numbers, not milestone, dis)
+
+    @classmethod
+    def parse(cls, s):
+        """Return the Version for a version string, or None if it is not a version number."""
+        try:
+            return cls._cache[s]
+        except KeyError:
+            pass
+        match = VERSION_REGEX.match(s)
+        version = None
+        if match:
+            major, minor, patch, milestone, dis = match.groups()
+            version = cls(s, (int(major), int(minor), int(patch)), milestone is not None, int(dis) if dis else 0)
+        return cls._cache.setdefault(s, version)
+
+    @property
+    def kind(self):
+        """Either "onprem" (e.g. 2.7.8) or "cloud" (Takt versions, e.g. 2004.1.2), None otherwise."""
+        if self.numbers[0] <= 99:
+            return "onprem"
+        if 1000 <= self.numbers[0] <= 9999:
+            return "cloud"
+        return None
+
+    def comparable(self, other):
+        """Find out whether two versions can be compared meaningfully, i.e. are of the same kind."""
+        return self.kind is not None and self.kind == other.kind
+
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key == other.key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.string
+
+    def __repr__(self):
+        return "Version({!r})".format(self.string)
+
+
+def parse_version_or_tag(s):
+    """Return the Version of a version string or release tag (e.g. rel/2005.1.1), or None."""
+    return Version.parse(s[4:] if s.startswith("rel/") else s)
+
+
+def version_key(s):
+    """Sort key for version strings and release tags: versions are ordered by Version, after all other
+    strings (which are ordered lexicographically)."""
+    version = parse_version_or_tag(s.rstrip("/"))
+    return (1, version.key, s) if version else (0, (), s)
+
+
+def sort_versions(versions, reverse=False):
+    """Sort version strings and release tags by version (see version_key)."""
+    return sorted(versions, key=version_key, reverse=reverse)
+
+
+def max_version(versions):
+    """Return the newest of the given version strings or release tags (see version_key)."""
+    return max(versions, key=version_key)
+
+
 def is_version_str(s):
     """Find out whether a string is a version number."""
-    if re.search("^[0-9]+\\.[0-9]+\\.[0-9]+(-ms)?(-dis\\.[0-9]+)?$", s):
-        return True
-    return False
+    return Version.parse(s) is not None
 
 
 def is_branch_str(s):
@@ -42,25 +142,61 @@ def version_to_tag(version):
 
 def tag_to_version(s):
     """Get the version number from a release tag, e.g. rel/2005.1.1 -> 2005.1.1."""
-    match = re.search("^rel\\/([0-9]+\\.[0-9]+\\.[0-9]+)$", s)
-    if match:
-        return match.group(1)
+    if not s.startswith("rel/"):
+        return None
+    version = Version.parse(s[4:])
+    if version and not version.milestone and not version.dis:
+        return version.string
+    return None
+
+
+_proper_versions = {}
+_proper_versions_lock = threading.Lock()
+
+
+def find_version_file(base_path, max_depth=VERSION_FILE_DEPTH):
+    """Find the cfg/VERSION file of an unpacked repository or archive below base_path.
+    base_path/cfg/VERSION is probed first, then <dir>/cfg/VERSION for the subdirectories of each level,
+    down to max_depth levels. Hidden directories and dependencies (e.g. node_modules) are not searched.
+    Returns the path of the file, or None if there is none."""
+    level = [base_path]
+    for depth in range(max_depth + 1):
+        subdirs = []
+        for path in level:
+            candidate = os.path.join(path, "cfg", "VERSION")
+            if os.path.isfile(candidate):
+                return candidate
+            if depth == max_depth:
+                continue
+            try:
+                with os.scandir(path) as entries:
+                    subdirs.extend(sorted(e.path for e in entries if e.is_dir(follow_symlinks=False)
+                                          and not e.name.startswith(".") and e.name not in PRUNED_DIRS))
+            except OSError:
+                continue
+        level = subdirs
     return None
 
 
 def get_proper_version(base_path, version):
     """Return a proper version number for the given path/version.
     If version_name is a proper version name, just return that.
-    Otherwise, assume that base_path contains a github revision and get the version from cfg/VERSION.
+    Otherwise, assume that base_path contains a github revision and get the version from cfg/VERSION
+    (see find_version_file). The result is cached per base_path.
     NB: This is not an accurate version number, since not every branch has an exact version number.
     It is rather a "minimum version number", which might contain any number of changes made after the
     last increase of the version number in cfg/VERSION. """
     if re.match(r"^[0-9.]+$", version):
         return version
-    else:
-        for path, subdirs, subfiles in os.walk(base_path):
-            if path.endswith("/cfg") and "VERSION" in subfiles:
-                return open(path + "/VERSION", 'r').read().rstrip()
+    key = os.path.abspath(base_path)
+    with _proper_versions_lock:
+        if key not in _proper_versions:
+            version_file = find_version_file(base_path)
+            if version_file:
+                with open(version_file, 'r') as f:
+                    _proper_versions[key] = f.read().rstrip()
+        if key in _proper_versions:
+            return _proper_versions[key]
 
     # Fail if it neither looks like a proper version number, nor has no cfg/VERSION file
     log.fatal("could not find proper version number for %s in %s", version, base_path)
@@ -72,6 +208,9 @@ def version_kind(version):
     - "onprem" (e.g. 2.7.8)
     - "cloud" (e.g. 2004.1.2)
     """
+    parsed = Version.parse(version)
+    if parsed:
+        return parsed.kind
     if re.match(r"^[0-9]{4}\..*", version):
         return "cloud"
     elif re.match(r"^[0-9]{1,2}\..*", version):
@@ -84,28 +223,19 @@ def version_leq(vstr1, vstr2):
     NB: returns None if two version strings are incomparable, i.e. one is an
     on-prem version (e.g. 2.7.4) and the other a cloud version (e.g. 2004.1.2).
     """
-
-    # convert release tags to version numbers
-    if tag_to_version(vstr1):
-        vstr1 = tag_to_version(vstr1)
-    if tag_to_version(vstr2):
-        vstr2 = tag_to_version(vstr2)
+    ver1 = parse_version_or_tag(vstr1)
+    ver2 = parse_version_or_tag(vstr2)
 
     # check version format
-    if not is_version_str(vstr1):
+    if not ver1:
         raise RuntimeError("Unrecognized version format: " + vstr1)
-    if not is_version_str(vstr2):
+    if not ver2:
         raise RuntimeError("Unrecognized version format: " + vstr2)
-    
-    ver1 = [int(v) for v in vstr1.split(".")]
-    ver2 = [int(v) for v in vstr2.split(".")]
 
     # take care not to compare short (e.g. 2.7.xy) with Takt (e.g. 2007.x.y) versions
-    if ver1[0] <= 99 and ver2[0] <= 99:
-        return ver1 <= ver2  # both primary version numbers are short -- okay
-    if ver1[0] >= 1000 and ver2[0] >= 1000:
-        return ver1 <= ver2  # both primary version numbers are Takt versions -- okay
-    return None  # no meaningful comparison possible, return None
+    if not ver1.comparable(ver2):
+        return None  # no meaningful comparison possible, return None
+    return ver1 <= ver2
 
 
 def get_releasepack_versions(branch):
@@ -130,8 +260,8 @@ def get_versions(component):
     """Get vflow-base versions for all upgrade-relevant releasepack versions."""
     version_list = set()
     for base_version in get_releasepack_versions():
-        pom_xml = parse_xml(ARTIFACTORY_URL + base_version + "/SAPDataHub-" + base_version + ".pom")
-        rel = pom_xml.find("./properties/hldep." + component + ".version").text
+        pom = read_pom(ARTIFACTORY_URL + base_version + "/SAPDataHub-" + base_version + ".pom")
+        rel = pom["properties"]["hldep." + component + ".version"]
         vsolution = read_json_from(VSOLUTION_URL + rel + "/deps/vflow.dep")
         version_list.add(str(vsolution['VERSION']))
     return sorted(version_list)
@@ -148,40 +278,56 @@ def get_vsolution_version(vsolution_version, repo, component):
 def get_dep_version(pom_url, dep):
     """Get version of given dependency from a POM file (Maven XML) on Artifactory."""
     log.debug("Retrieving %s version from %s", dep, pom_url)
-    xml = parse_xml(pom_url)
-    return xml.find("properties/hldep." + dep + ".version").text
+    pom = read_pom(pom_url)
+    return pom["properties"]["hldep." + dep + ".version"]
+
+
+def read_dis_versions():
+    """Read the versions of DI Embedded releases. See https://github.wdf.sap.corp/bdh/dis-release/blob/master/dis-versions.yaml
+    The file is parsed once per process; its cached copy is revalidated with a conditional GET (see read_revalidated)."""
+    global _dis_versions
+    with _dis_versions_lock:
+        if _dis_versions is None:
+            log.debug("Using base versions from %s", DIS_VERSIONS_URL)
+            try:
+                content = read_revalidated(DIS_VERSIONS_URL)
+                if content is None:
+                    raise RuntimeError("download failed")
+                _dis_versions = yaml.safe_load(content)
+            except Exception as ex:
+                log.error("Getting version info from %s failed: %s.", DIS_VERSIONS_URL, ex)
+                sys.exit(2)
+    return _dis_versions
+
+
+def get_dis_versions(rversion):
+    """Get the versions of all components of a DI Embedded release, as dict component -> version."""
+    dis_versions = read_dis_versions()
+    if rversion not in dis_versions:
+        log.error("Unknown DIS release version: %s", rversion)
+        sys.exit(3)
+    return dict(dis_versions[rversion])
 
 
 def get_dis_version(rversion, component):
     """Get version of given DI Embedded component. See version info at https://github.wdf.sap.corp/bdh/dis-release/blob/master/dis-versions.yaml"""
-    version_info = "https://github.wdf.sap.corp/raw/bdh/dis-release/master/dis-versions.yaml"
-    log.debug("Using base versions from %s", version_info)
-    try:
-        dis_versions_json = yaml.safe_load(read_from_url_or_file(version_info))
-    except Exception as ex:
-        log.error("Getting version info from %s failed: %s.", version_info, ex)
-        sys.exit(2)
-    if rversion not in dis_versions_json:
-        log.error("Unknown DIS release version: %s", rversion)
-        sys.exit(3)
-    if component not in dis_versions_json[rversion]:
+    release = get_dis_versions(rversion)
+    if component not in release:
         log.error("Component not found in DIS release: %s, DIS release version %s", component, rversion)
         sys.exit(4)
-    return dis_versions_json[rversion][component]
+    return release[component]
 
 
 def get_newest_release():
     version_string = read_regex_from(ARTIFACTORY_URL + "maven-metadata.xml", r"<version>(.*)</version>")
-    version_list = [v for v in version_string]
-    return sorted(version_list)[-1]
+    return max_version(version_string)
 
 
 def get_newest_milestone(artifact):
     version_string = read_regex_from(ARTIFACTORY_REL_URL + artifact + "/", r"<text>(.*)</text>")
     log.debug("getting newest milestones from %s: %s",
               ARTIFACTORY_REL_URL + artifact + "/", version_string)
-    version_list = [v for v in version_string]
-    return sorted(version_list)[-1]
+    return max_version(version_string)
 
 
 def get_component_version(repo, branch):
@@ -191,9 +337,16 @@ def get_component_version(repo, branch):
     version = tag_to_version(branch)
     if version:
         return version
+    index = get_version_index() if is_immutable_ref(branch) else None
+    if index:
+        version = index.get_cfg_version(repo, branch)
+        if version:
+            return version
     version = get_from_github(repo, "cfg/VERSION", branch, not_found_ok=False).strip()
     if version == "../VERSION":  # needed for velocity/axino
         version = get_from_github(repo, "VERSION", branch, not_found_ok=False).strip()
+    if index:
+        index.put_cfg_version(repo, branch, version)
     return version
 
 
@@ -203,13 +356,17 @@ def parse_options(parser):
     parser.add_argument('--component',
                         help="Component to get version for. One of {}.".format(COMPONENTS))
     parser.add_argument('--branch', help="Branch to get component versions for")
-    parser.add_argument('--base-version', help="Base version to get component versions for")
+    parser.add_argument('--base-version', nargs='+', help="Base version(s) to get component versions for")
     parser.add_argument('--log-level', default='INFO',
                         help="Level of logging. One of ERROR, WARNING, INFO, or DEBUG")
+    parser.add_argument('--update-index', action='store_true',
+                        help="Add new releases from Artifactory to the local version index first")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the versions of all components (or only --component) for all base versions as JSON")
 
     # parse and check options
     options = parser.parse_args()
-    if not options.component:
+    if not options.component and not options.json:
         print("#### [level=error] COMPONENT variable is not set, e.g. --component=VFLOW.")
         print("Supported components: {} (or the corresponding repository names).".format(COMPONENTS))
         sys.exit(-1)
@@ -220,102 +377,289 @@ def parse_options(parser):
     return options
 
 
+# How to find the version of each component in a releasepack:
+# (component, repository, key in dis-versions.yaml, POM property hldep.<name>.version, secondary lookup)
+# The secondary lookup is either (repository, component) of a vsolution-like .dep file, or FLOWAGENT_POM
+# for versions defined in the parent pom.xml of datahub-flowagent.
+FLOWAGENT_POM = "flowagent-pom"
+COMPONENT_SOURCES = [
+    ("VFLOW", "velocity/vflow", "vsolution", "hl-vsolution", ("velocity/vsolution", "vflow")),
+    ("VFLOW_SUB_ABAP", "velocity/vflow-sub-abap", "vsolution", "hl-vsolution", ("velocity/vsolution", "vflow-sub-abap")),
+    ("AXINO", "velocity/axino", "vsolution", "hl-vsolution", ("velocity/vsolution", "axino")),
+    ("ML_API", "dsp/ml-api", None, "dsp-release", ("dsp/dsp-release", "ml-api")),
+    ("ML_DM_API", "dsp/ml-dm-api", None, "dsp-release", ("dsp/dsp-release", "ml-dm-api")),
+    ("ML_TRACKING", "dsp/ml-tracking", None, "dsp-release", ("dsp/dsp-release", "ml-tracking")),
+    ("DSP_GITSERVER", "dsp/dsp-gitserver", None, "dsp-release", ("dsp/dsp-release", "dsp-git-server")),
+    ("APP_BASE", "bdh/datahub-app-base", "datahub-app-base", "datahub-app-base", None),
+    ("APP_DATA", "bdh/datahub-app-data", None, "datahub-app-data", None),
+    ("HANALITE", None, None, "hl-lib", None),
+    ("VSYSTEM", "velocity/vsystem", "vsystem", "hl-vsystem", None),
+    ("STORAGEGATEWAY", "bigdataservices/storagegateway", "storagegateway", "storagegateway", None),
+    ("FLOWAGENT", "bdh/datahub-flowagent", "datahub-flowagent", "datahub-flowagent", None),
+    ("DQ_INTEGRATION", "bdh/datahub-dq-integration", "datahub-flowagent", "datahub-flowagent", FLOWAGENT_POM),
+    ("DIAGNOSTICS", "bdh/diagnostics", "diagnostics", "diagnostics", None),
+    ("CODE_SERVER", "velocity/code-server", None, "code-server", None),
+    ("CCM", "orca/connection-service", "connection-service", None, None),
+    ("FEDERATION", "bdh/federation", "federation-service", None, None),
+    ("RMS", "bdh/rms", "rms", None, None),
+]
+
+# Number of secondary lookups (.dep files, pom.xml) made concurrently
+MANIFEST_WORKERS = 8
+
+# Number of concurrent lookups when collecting the versions of all repositories (1: one after another)
+VERSION_WORKERS = int(os.getenv("UPGRADE_VALIDATION_VERSION_WORKERS", 8))
+
+_dis_versions = None
+_dis_versions_lock = threading.Lock()
+_manifests = {}
+_manifest_locks = {}
+_manifests_lock = threading.Lock()
+_version_index = None
+
+
+def get_component_name(component):
+    """Return the component name (e.g. VFLOW) for a component or repository name (e.g. velocity/vflow)."""
+    for name, repo, _dis_key, _pom_key, _lookup in COMPONENT_SOURCES:
+        if component in (name, repo):
+            return name
+    if component == "RELEASEPACK":
+        return component
+    log.fatal("Unsupported component name: %s", component)
+    sys.exit(3)
+
+
+class ReleaseManifest():
+    """Versions of all components of a releasepack version.
+    The SAPDataHub POM (or dis-versions.yaml for DI Embedded releases) is loaded once, and all components
+    are resolved in one pass. Secondary lookups, e.g. of vsolution .dep files, are made concurrently."""
+
+    def __init__(self, rversion, versions=None):
+        self.rversion = rversion
+        self.is_dis = "-dis." in rversion
+        self.pom_url = "https://int.repositories.cloud.sap/artifactory"
+        if rversion.endswith("-ms"):
+            self.pom_url += "/deploy-milestones/"
+        else:
+            self.pom_url += "/build-releases/"
+        self.pom_url += "com/sap/datahub/SAPDataHub/{v}/SAPDataHub-{v}.pom".format(v=rversion)
+        self.versions = {"RELEASEPACK": rversion}
+        self.errors = {}
+        self.missing = set()
+        if versions is None:
+            self.resolve()
+        else:
+            self.versions.update(versions)
+
+    def resolve(self):
+        """Resolve the versions of all components."""
+        if self.is_dis:
+            release = get_dis_versions(self.rversion)
+        else:
+            try:
+                properties = read_pom(self.pom_url)["properties"]
+            except Exception as ex:
+                log.fatal("Reading %s failed: %s", self.pom_url, ex)
+                sys.exit(-1)
+
+        # Get the versions defined in the manifest, and collect the secondary lookups
+        lookups = {}
+        for name, _repo, dis_key, pom_key, lookup in COMPONENT_SOURCES:
+            if self.is_dis:
+                if not dis_key:
+                    self.versions[name] = None
+                    continue
+                if dis_key not in release:
+                    self.missing.add(name)
+                    continue
+                dep_version = release[dis_key]
+            else:
+                if not pom_key:
+                    self.versions[name] = None
+                    continue
+                dep_version = properties.get("hldep." + pom_key + ".version")
+                if dep_version is None:
+                    log.debug("hldep.%s.version not found in %s", pom_key, self.pom_url)
+                    self.versions[name] = None
+                    continue
+            if lookup:
+                lookups.setdefault((lookup, dep_version), []).append(name)
+            else:
+                self.versions[name] = dep_version
+
+        # Make the secondary lookups concurrently
+        def secondary_lookup(key):
+            lookup, dep_version = key
+            try:
+                if lookup == FLOWAGENT_POM:
+                    flowagent_pom_url = "https://github.wdf.sap.corp/raw/bdh/datahub-flowagent/" + version_to_tag(dep_version) + "/build/parent/pom.xml"
+                    return get_dep_version(flowagent_pom_url, "datahub-dq-integration")
+                return get_vsolution_version(dep_version, *lookup)
+            except Exception as ex:
+                return ex
+
+        if lookups:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(MANIFEST_WORKERS, len(lookups))) as executor:
+                for names, result in zip(lookups.values(), executor.map(telemetry.with_caller(secondary_lookup), lookups)):
+                    for name in names:
+                        if isinstance(result, Exception):
+                            self.errors[name] = result
+                        else:
+                            self.versions[name] = result
+
+    def get(self, component):
+        """Get the version of a component (component or repository name), or None if it is not part of the release."""
+        name = get_component_name(component)
+        if name in self.errors:
+            raise self.errors[name]
+        if name in self.missing:
+            log.error("Component not found in DIS release: %s, DIS release version %s", component, self.rversion)
+            sys.exit(4)
+        if name == "APP_DATA" and not self.is_dis:
+            major_version = int(self.rversion.split('.')[0])
+            if major_version == 2 or (major_version > 1900 and major_version < 2003):
+                log.error("## The datahub-app-data version is not available in " + self.pom_url + ". Please request version of the APP_BASE.")
+                return "0"
+        return self.versions.get(name)
+
+    def get_all(self, components=COMPONENTS):
+        """Get the versions of the given components (default: all). Components which are not part of the
+        release, or whose version cannot be resolved, are mapped to None."""
+        versions = {}
+        for component in components:
+            name = get_component_name(component)
+            if name in self.errors:
+                log.error("cannot resolve version of %s in release %s: %s", component, self.rversion, self.errors[name])
+                versions[component] = None
+            elif name in self.missing:
+                versions[component] = None
+            else:
+                versions[component] = self.get(component)
+        return versions
+
+
+def get_release_manifest(rversion):
+    """Return the manifest of a releasepack version. Each manifest is loaded only once per process."""
+    with _manifests_lock:
+        lock = _manifest_locks.setdefault(rversion, threading.Lock())
+    with lock:
+        if rversion not in _manifests:
+            # dis-versions.yaml is read from a branch and may change, so DIS releases are not indexed
+            index = None if "-dis." in rversion else get_version_index()
+            versions = index.get_release(rversion) if index else None
+            if versions is not None and not all(name in versions for name, *_ in COMPONENT_SOURCES):
+                log.debug("release %s is indexed without all components, resolving it again", rversion)
+                versions = None
+            if versions is not None:
+                log.debug("using indexed component versions of release %s", rversion)
+                _manifests[rversion] = ReleaseManifest(rversion, versions)
+            else:
+                _manifests[rversion] = ReleaseManifest(rversion)
+                if index and not _manifests[rversion].errors:
+                    index.put_release(_manifests[rversion])
+        return _manifests[rversion]
+
+
+class VersionIndex():
+    """Persistent index (SQLite) of the component versions of releases, and of cfg/VERSION of tagged revisions.
+    Both never change once published, so they are derived from Artifactory and GitHub only once per machine.
+    The index is updated on demand, and with update() for all new releases in maven-metadata.xml.
+    Indexed releases are dropped when COMPONENT_SOURCES changes."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS releases (release TEXT PRIMARY KEY)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS components (release TEXT, component TEXT, version TEXT, "
+                            "PRIMARY KEY (release, component))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS cfg_versions (repo TEXT, ref TEXT, version TEXT, PRIMARY KEY (repo, ref))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            sources = hashlib.sha256(repr(COMPONENT_SOURCES).encode()).hexdigest()
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'component_sources'").fetchone()
+            if not row or row[0] != sources:
+                if row:
+                    log.info("component sources changed, dropping the indexed releases of %s", filename)
+                self.db.execute("DELETE FROM components")
+                self.db.execute("DELETE FROM releases")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('component_sources', ?)", (sources,))
+
+    def get_release(self, rversion):
+        """Return the component versions of a release (component -> version or None), or None if not indexed."""
+        with self.lock:
+            if not self.db.execute("SELECT 1 FROM releases WHERE release = ?", (rversion,)).fetchone():
+                return None
+            rows = self.db.execute("SELECT component, version FROM components WHERE release = ?", (rversion,)).fetchall()
+        return dict(rows)
+
+    def put_release(self, manifest):
+        """Store the component versions of a release manifest."""
+        rows = [(manifest.rversion, name, version) for name, version in manifest.versions.items() if name != "RELEASEPACK"]
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO components VALUES (?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO releases VALUES (?)", (manifest.rversion,))
+
+    def releases(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT release FROM releases")}
+
+    def get_cfg_version(self, repo, ref):
+        with self.lock:
+            row = self.db.execute("SELECT version FROM cfg_versions WHERE repo = ? AND ref = ?", (repo, ref)).fetchone()
+        return row[0] if row else None
+
+    def put_cfg_version(self, repo, ref, version):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO cfg_versions VALUES (?, ?, ?)", (repo, ref, version))
+
+    def update(self):
+        """Index the releases listed in maven-metadata.xml which are not indexed yet."""
+        releases = self.releases()
+        new_releases = [v for v in read_regex_from(ARTIFACTORY_URL + "maven-metadata.xml", r"<version>(.*)</version>")
+                        if v not in releases]
+        log.info("indexing %d new releases", len(new_releases))
+        for rversion in new_releases:
+            try:
+                get_release_manifest(rversion)
+            except (Exception, SystemExit) as ex:
+                log.warning("cannot index release %s: %s", rversion, ex)
+
+
+def get_version_index():
+    """Return the version index, or None if it is disabled.
+    Like the fetch cache, the index is not used when recording or replaying responses."""
+    global _version_index
+    if not VERSION_INDEX or httpclient.get_bundle():
+        return None
+    with _manifests_lock:
+        if _version_index is None:
+            _version_index = VersionIndex(VERSION_INDEX)
+    return _version_index
+
+
 def handle_component(component, rversion):
     """Get version for given component and release version."""
-    pom_url = "https://int.repositories.cloud.sap/artifactory"
-    if rversion.endswith("-ms"):
-        pom_url += "/deploy-milestones/"
-    else:
-        pom_url += "/build-releases/"
-    pom_url += "com/sap/datahub/SAPDataHub/{v}/SAPDataHub-{v}.pom".format(v=rversion)
-
-    is_dis = "-dis." in rversion
-
-    if component in [ "RELEASEPACK" ]:
-        return rversion
-
-    # Main vsolutions
-    elif component in [ "VFLOW", "velocity/vflow" ]:
-        dep_version = get_dis_version(rversion, "vsolution") if is_dis else get_dep_version(pom_url, "hl-vsolution") 
-        return get_vsolution_version(dep_version, "velocity/vsolution", "vflow")
-    elif component in [ "VFLOW_SUB_ABAP", "velocity/vflow-sub-abap" ]:
-        dep_version = get_dis_version(rversion, "vsolution") if is_dis else get_dep_version(pom_url, "hl-vsolution")
-        return get_vsolution_version(dep_version, "velocity/vsolution", "vflow-sub-abap")
-    elif component in [ "AXINO", "velocity/axino" ]:
-        dep_version = get_dis_version(rversion, "vsolution") if is_dis else get_dep_version(pom_url, "hl-vsolution")
-        return get_vsolution_version(dep_version, "velocity/vsolution", "axino")
-
-    # Machine learning
-    elif component in [ "ML_API", "dsp/ml-api" ]:
-        if is_dis:
-            return None
-        dep_version = get_dep_version(pom_url, "dsp-release")
-        return get_vsolution_version(dep_version, "dsp-release", "dsp/dsp-release", "ml-api")
-    elif component in [ "ML_DM_API", "dsp/ml-dm-api" ]:
-        if is_dis:
-            return None
-        dep_version = get_dep_version(pom_url, "dsp-release")
-        return get_vsolution_version(dep_version, "dsp/dsp-release", "ml-dm-api")
-    elif component in [ "ML_TRACKING", "dsp/ml-tracking" ]:
-        if is_dis:
-            return None
-        dep_version = get_dep_version(pom_url, "dsp-release")
-        return get_vsolution_version(dep_version, "dsp/dsp-release", "ml-tracking")
-    elif component in [ "DSP_GITSERVER", "dsp/dsp-gitserver" ]:
-        if is_dis:
-            return None
-        dep_version = get_dep_version(pom_url, "dsp-release")
-        return get_vsolution_version(dep_version, "dsp/dsp-release", "dsp-git-server")
-
-    # Main components
-    elif component in [ "APP_BASE", "bdh/datahub-app-base" ]:
-        return get_dis_version(rversion, "datahub-app-base") if is_dis else get_dep_version(pom_url, "datahub-app-base")
-    elif component in [ "APP_DATA", "bdh/datahub-app-data" ]:
-        if is_dis:
-            return None
-        major_version = int(rversion.split('.')[0])
-        if major_version == 2 or (major_version > 1900 and major_version < 2003):
-            log.error("## The datahub-app-data version is not available in " + pom_url + ". Please request version of the APP_BASE.")
-            return "0"
-        else:
-            return get_dep_version(pom_url, "datahub-app-data")
-    elif component in [ "HANALITE" ]:
-        if is_dis:
-            return None
-        return get_dep_version(pom_url, "hl-lib")
-    elif component in [ "VSYSTEM", "velocity/vsystem" ]:
-        return get_dis_version(rversion, "vsystem") if is_dis else get_dep_version(pom_url, "hl-vsystem")
-    elif component in [ "STORAGEGATEWAY", "bigdataservices/storagegateway" ]:
-        return get_dis_version(rversion, "storagegateway") if is_dis else get_dep_version(pom_url, "storagegateway")
-    elif component in [ "FLOWAGENT", "bdh/datahub-flowagent" ]:
-        return get_dis_version(rversion, "datahub-flowagent") if is_dis else get_dep_version(pom_url, "datahub-flowagent")
-    elif component in [ "DQ_INTEGRATION", "bdh/datahub-dq-integration" ]:
-        dep_version = get_dis_version(rversion, "datahub-flowagent") if is_dis else get_dep_version(pom_url, "datahub-flowagent")
-        flowagent_tag = version_to_tag(dep_version)
-        flowagent_pom_url = "https://github.wdf.sap.corp/raw/bdh/datahub-flowagent/" + flowagent_tag + "/build/parent/pom.xml"
-        return get_dep_version(flowagent_pom_url, "datahub-dq-integration")
-    elif component in [ "DIAGNOSTICS", "bdh/diagnostics" ]:
-        return get_dis_version(rversion, "diagnostics") if is_dis else get_dep_version(pom_url, "diagnostics")
-    elif component in [ "CODE_SERVER", "velocity/code-server" ]:
-        if is_dis:
-            return None
-        return get_dep_version(pom_url, "code-server")
-    elif component in [ "CCM", "orca/connection-service" ]:
-        return get_dis_version(rversion, "connection-service") if is_dis else None
-    elif component in ["FEDERATION", "bdh/federation"]:
-        return get_dis_version(rversion, "federation-service") if is_dis else None
-    elif component in ["RMS", "bdh/rms"]:
-        return get_dis_version(rversion, "rms") if is_dis else None
-    else:
-        log.fatal("Unsupported component name: %s", component)
-        sys.exit(3)
+    return get_release_manifest(rversion).get(component)
+
+
+def handle_components(rversions, components=COMPONENTS, workers=VERSION_WORKERS):
+    """Get the versions of the given components (default: all) for all given release versions.
+    The manifests of the releases are loaded concurrently. Returns a dict release -> component -> version."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(rversions)))) as executor:
+        manifests = list(executor.map(telemetry.with_caller(get_release_manifest), rversions))
+    return {m.rversion: m.get_all(components) for m in manifests}
 
 
 class VersionCollector():
     """Collects base and target versions for components based on repository metadata."""
 
-    def __init__(self, repo, base_version, target_version, test_flag, test_entries, test_all, logger, repo_config="swagger_specs.json"):
+    def __init__(self, repo, base_version, target_version, test_flag, test_entries, test_all, logger, repo_config="swagger_specs.json",
+                 workers=VERSION_WORKERS):
         self.logger = logger
+        self.workers = workers
 
         # Load repository / specification metadata
         self.specs = json.load(open(repo_config))
@@ -335,6 +679,10 @@ class VersionCollector():
         self.component_target_versions = {}
         self.fork = None
 
+        # Releasepack base versions leading to each (repository, base version tag) of the tests,
+        # so that test results can be attributed to the upgrade paths of the releasepacks.
+        self.base_releases = {}
+
         logger.info(u'Collecting component versions \U0001F37A')
 
         # We allow custom base versions (specified in repository metadata) only if it
@@ -382,6 +730,7 @@ class VersionCollector():
             # To ensure that the used base versions are not "too new", we later compare the version numbers
             # of the components.
             self.releasepack_base_versions = get_releasepack_versions("master")
+            self.map(get_release_manifest, self.releasepack_base_versions)
 
         # Add tests for this repository (component) only.
         # Component target version is already given by the argument
@@ -398,7 +747,11 @@ class VersionCollector():
             # See comment above regarding master branch
             self.releasepack_base_versions = get_releasepack_versions("master")
 
+        # Load the manifests of all involved releases concurrently
+        self.map(get_release_manifest, self.releasepack_base_versions + ([target_version] if is_version_str(target_version) else []))
+
         # Add tests for all repos
+        repos = []
         for r in self.specs["repositories"]:
             if (test_all or r.get(test_flag, True) == True) and (not test_entries or r.get(test_entries, False)):
 
@@ -417,39 +770,73 @@ class VersionCollector():
 
                 # Add tests cases
                 if tv:
-                    self.do_init_repo_tests(r, base_version, tv, test_entries)
+                    repos.append((r, tv))
+        self.init_repo_tests(repos, base_version, test_entries)
+
+    def map(self, func, items):
+        """Apply func to all items, concurrently using self.workers threads, and return the results in order."""
+        items = list(items)
+        if self.workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as executor:
+            return list(executor.map(telemetry.with_caller(func), items))
 
     def do_init_repo_tests(self, repo_details, base_version, target_version, test_entries):
         """Find out base and target version for a specific repository and add test case to self.tests"""
+        self.init_repo_tests([(repo_details, target_version)], base_version, test_entries)
 
-        # Get repository name
-        if "name" not in repo_details:
-            raise RuntimeError("Invalid repository specification: {}".format(repo_details))
-        repo = repo_details["name"]
-
-        # Add to list of checked repositories
-        self.repositories.append(repo)
+    def init_repo_tests(self, repos, base_version, test_entries):
+        """Find out base and target versions for a list of (repository details, target version) pairs and
+        add test cases to self.tests. The versions of all repositories are looked up concurrently, but the
+        test cases are added in the order of the repositories."""
 
         # Get component base versions
-        if self.allow_custom_base_versions and "baseVersions" in repo_details:
-            component_base_versions = repo_details["baseVersions"]
-        else:
-            if base_version:
-                component_base_versions = [base_version]
-            else:
-                component_base_versions = set()
-                for rversion in self.releasepack_base_versions:
-                    v = handle_component(repo, rversion)
-                    if v:
-                        component_base_versions.add(v)
-
-                component_base_versions = sorted(component_base_versions)
+        component_base_versions = []
+        for repo_details, _ in repos:
+            if "name" not in repo_details:
+                raise RuntimeError("Invalid repository specification: {}".format(repo_details))
+            component_base_versions.append(self.get_component_base_versions(repo_details, base_version))
 
         # The version could be git branches, tags or a commit ids.
         # We now get corresponding component versions the tag or from cfg/VERSION.
-        r = repo_details.get("fork", repo)
-        cfg_base_versions = [ get_component_version(r, v) for v in component_base_versions]
-        cfg_target_version = get_component_version(r, target_version)
+        lookups = set()
+        for (repo_details, target_version), versions in zip(repos, component_base_versions):
+            r = repo_details.get("fork", repo_details["name"])
+            lookups.update((r, v) for v in list(versions) + [target_version])
+        lookups = sorted(lookups)
+        cfg_versions = dict(zip(lookups, self.map(lambda lookup: get_component_version(*lookup), lookups)))
+
+        for (repo_details, target_version), versions in zip(repos, component_base_versions):
+            r = repo_details.get("fork", repo_details["name"])
+            cfg_base_versions = []
+            for v in versions:
+                cfg_version = cfg_versions[(r, v)]
+                if cfg_version not in cfg_base_versions:
+                    cfg_base_versions.append(cfg_version)
+                releases = self.base_releases.setdefault((repo_details["name"], version_to_tag(cfg_version)), [])
+                releases.extend(rv for rv in versions[v] if rv not in releases)
+            cfg_target_version = cfg_versions[(r, target_version)]
+            self.add_repo_tests(repo_details, target_version, cfg_base_versions, cfg_target_version, test_entries)
+
+    def get_component_base_versions(self, repo_details, base_version):
+        """Get the component base versions of a repository, mapped to the releasepack versions they are part of."""
+        if self.allow_custom_base_versions and "baseVersions" in repo_details:
+            return {v: [] for v in repo_details["baseVersions"]}
+        if base_version:
+            return {base_version: []}
+        component_base_versions = {}
+        for rversion in self.releasepack_base_versions:
+            v = handle_component(repo_details["name"], rversion)
+            if v:
+                component_base_versions.setdefault(v, []).append(rversion)
+        return {v: component_base_versions[v] for v in sort_versions(component_base_versions)}
+
+    def add_repo_tests(self, repo_details, target_version, cfg_base_versions, cfg_target_version, test_entries):
+        """Add test cases for a repository, given the component versions from cfg/VERSION."""
+        repo = repo_details["name"]
+
+        # Add to list of checked repositories
+        self.repositories.append(repo)
 
         # Now we need to compare the base versions to the target version.
         # We need to make sure the base version is predecessor of the target version.
@@ -477,20 +864,85 @@ class VersionCollector():
         return
 
 
+class UpgradePlanner():
+    """Plans the minimal set of comparisons for the tests of a VersionCollector ("repo;path;base version").
+    Tests of the same file whose base and target versions are byte-identical are equivalent, e.g. if
+    several component versions contain the same specification. Only the first of them needs to run,
+    and its result applies to all others. A file missing in an existing ref is told apart from a ref which
+    does not exist, so that the test of a nonexistent ref still runs into its error."""
+
+    def __init__(self, tests, component_target_versions, fork=None):
+        self.tests = tests
+        self.component_target_versions = component_target_versions
+        self.fork = fork
+
+    def get_files(self, test):
+        """Return the (repo, path, version) tuples of the base and target version of a test, or None if
+        the test does not compare a single file."""
+        parts = test.split(";")
+        if len(parts) != 3 or parts[0] == "dummy":
+            return None
+        repo, path, base_version = parts
+        github_repo = self.fork if self.fork else repo
+        return [(github_repo, path, base_version), (github_repo, path, self.component_target_versions[repo])]
+
+    def plan(self):
+        """Return a dict mapping each test to run to the list of tests it covers (including itself),
+        in the order of the tests."""
+        files = [f for test in self.tests for f in self.get_files(test) or []]
+        identities = {}
+        for f, content in zip(files, get_many_from_github(files)):
+            if isinstance(content, Exception):
+                identities[f] = None  # let the test run into the error
+            elif content is False:
+                identities[f] = "missing"  # see below
+            else:
+                identities[f] = hashlib.sha256(content.encode("UTF-8")).hexdigest()
+        refs = sorted({(repo, ref) for (repo, _path, ref), identity in identities.items() if identity == "missing"})
+        if refs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(VERSION_WORKERS, len(refs)))) as executor:
+                missing_refs = {ref for ref, exists in zip(refs, executor.map(telemetry.with_caller(lambda r: ref_exists(*r)), refs)) if not exists}
+            for f in identities:
+                if f[0::2] in missing_refs:
+                    identities[f] = "missing-ref"
+
+        plan = {}
+        representatives = {}
+        for test in self.tests:
+            files = self.get_files(test)
+            key = None
+            if files and None not in [identities[f] for f in files]:
+                key = (files[0][0], files[0][1]) + tuple(identities[f] for f in files)
+            representative = representatives.setdefault(key, test) if key else test
+            plan.setdefault(representative, []).append(test)
+        return plan
+
+
 if __name__ == '__main__':
     options = parse_options(argparse.ArgumentParser())
     log.basicConfig(level=options.log_level, format="%(levelname)-7s %(message)s")
 
+    if options.update_index and get_version_index():
+        get_version_index().update()
+
     if options.base_version:
-        base_releasepack_versions = [options.base_version]
+        base_releasepack_versions = options.base_version
     else:
         base_releasepack_versions = get_releasepack_versions(options.branch)
 
+    if options.json:
+        components = [options.component] if options.component else COMPONENTS
+        releases = handle_components(base_releasepack_versions, components)
+        versions = {c: sort_versions({r[c] for r in releases.values() if r[c]}) for c in components}
+        json.dump({"base_versions": base_releasepack_versions, "releases": releases, "components": versions}, sys.stdout, indent=2)
+        print()
+        sys.exit(0)
+
     versions = set()
     for releasepack_version in base_releasepack_versions:
         v = handle_component(options.component, releasepack_version)
         if v:
             versions.add(v)
 
-    for version in sorted(versions):
+    for version in sort_versions(versions):
         print(version)
@@ -20,6 +20,7 @@ class Config():
         self.logger = logger
         self.tests = []
         self.component_target_versions = {}
+        self.base_releases = {}
         self.exceptions = {}
         self.path_scopes = {}
         self.fork = None
@@ -33,6 +34,7 @@ class Config():
         collector = VersionCollector(repo, base_version, target_version, "checkSwagger", "swaggerFiles", test_all, logger)
         self.tests = collector.tests
         self.component_target_versions = collector.component_target_versions
+        self.base_releases = collector.base_releases
         self.fork = collector.fork
 
         #  Also add dummy tests if we are checking multiple repositories
@@ -17,7 +17,8 @@ if __name__ == '__main__':
     for repo in specs["repositories"]:
         if not repo["swaggerFiles"] or len(repo["swaggerFiles"]) == 0:
             continue
-        repo_path = download_repo_from_github(repo["name"], branch)
+        spec_patterns = repo["swaggerFiles"] + [os.path.join(os.path.dirname(f), "*.yaml") for f in repo["swaggerFiles"]]
+        repo_path = download_repo_from_github(repo["name"], branch, include=spec_patterns)
         for spec_file in repo["swaggerFiles"]:
             spec_dir = os.path.dirname(spec_file)
             files[os.path.join(repo["name"], spec_file)] = os.path.join(repo_path, spec_file)
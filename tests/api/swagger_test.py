@@ -16,7 +16,8 @@ from path import append_path
 
 sys.path.append(sys.path[0] + "/../../")
 from pylibs.openapi import is_deprecated_spec
-from pylibs.fileops import get_from_github
+from pylibs.fileops import get_fetch_cache, get_many_from_github, ref_exists
+from pylibs.versioning import UpgradePlanner
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,19 @@ def warn(m):
     return
 
 
+def get_spec_files(config):
+    """Return (repo, path, version) tuples for the base and target versions of all tested specifications."""
+    files = []
+    for test in config.tests:
+        repo, path, base_version = test.split(";")
+        if repo == "dummy":
+            continue
+        github_repo = config.fork if config.fork else repo
+        files.append((github_repo, path, base_version))
+        files.append((github_repo, path, config.component_target_versions[repo]))
+    return files
+
+
 if __name__ == '__main__':
 
     # Parse command-line arguments
@@ -55,6 +69,9 @@ if __name__ == '__main__':
     parser.add_argument("-c", nargs="?", metavar="csv", dest="csv",
         help="path for csv change report")
 
+    parser.add_argument("--no-dedup", action="store_true", dest="no_dedup",
+        help="run all tests, even if their base and target specifications are identical to another test")
+
     pytest.args = parser.parse_args()
 
     # Set log level (default INFO)
@@ -77,6 +94,24 @@ if __name__ == '__main__':
     base_msg = "base version '{}'".format(pytest.args.base) if pytest.args.base else "all base versions"
     logger.info("Starting compatibility tests for %s, %s, target version '%s'", repo_msg, base_msg, pytest.args.target)
 
+    # Fetch base and target versions of all specifications concurrently, so that tests are served from the fetch cache
+    if get_fetch_cache():
+        logger.info("Prefetching specifications")
+        get_many_from_github(get_spec_files(pytest.args.config))
+
+    # Skip tests comparing the same specifications as another test; their results are taken from that test
+    if pytest.args.no_dedup:
+        pytest.plan = {test: [test] for test in pytest.args.config.tests}
+    else:
+        pytest.plan = UpgradePlanner(pytest.args.config.tests, pytest.args.config.component_target_versions,
+                                     pytest.args.config.fork).plan()
+        logger.info("Running %d distinct comparisons for %d tests", len(pytest.plan), len(pytest.args.config.tests))
+        for test, covered in pytest.plan.items():
+            if len(covered) > 1:
+                base_versions = [t.split(";")[2] for t in covered]
+                releases = [r for t in covered for r in pytest.args.config.base_releases.get(tuple(t.split(";")[0::2]), [])]
+                logger.info("%s covers base versions %s (releasepack base versions %s)", test, base_versions, releases)
+
     # Run pytest
     main_args = ["-s", "-v"]
     pytest.diffs = {}
@@ -89,7 +124,8 @@ if __name__ == '__main__':
     if pytest.args.csv:
         logger.info("Generating CSV change report %s", pytest.args.csv)
         with open(pytest.args.csv, "w", newline="") as csv_file:
-            for test, diff in sorted(pytest.diffs.items()):
+            results = [(covered, diff) for test, diff in pytest.diffs.items() for covered in pytest.plan.get(test, [test])]
+            for test, diff in sorted(results, key=lambda result: result[0]):
                 repo, _, base_version = test.split(";")
                 target_version = pytest.args.config.component_target_versions[repo]
                 diff.dump_csv(csv_file, repo, base_version, target_version, pytest.args.config.exceptions)
@@ -101,7 +137,7 @@ if __name__ == '__main__':
 def pytest_generate_tests(metafunc):
     """Generate separate test for every Swagger/OpenAPI file. Instantiates test_api function for all Swagger/OpenAPI files."""
     if "test" in metafunc.fixturenames:
-        metafunc.parametrize("test", pytest.args.config.tests)
+        metafunc.parametrize("test", list(pytest.plan))
 
 
 def test_api(test):
@@ -126,19 +162,23 @@ def test_api(test):
     # Register diff for this test
     pytest.diffs[test] = Diff()
 
-    # Load base version
-    base_text = get_from_github(github_repo, path, base_version, True)
+    # Load base and target version
+    base_text, target_text = get_many_from_github([(github_repo, path, base_version), (github_repo, path, target_version)])
+    for text in [base_text, target_text]:
+        if isinstance(text, Exception):
+            raise text
+
+    # Check base version
     if not base_text:
-        get_from_github(github_repo, "README.md", base_version, False)
+        check_version_exists(github_repo, base_version)
         warn("Skipped API check because specification is not part of base version")
         return
     base = yaml.safe_load(base_text)
     base_scope = pytest.args.config.get_scope(file, base)
 
-    # Load target version
-    target_text = get_from_github(github_repo, path, target_version, True)
+    # Check target version
     if not target_text:
-        get_from_github(github_repo, "README.md", target_version, False)
+        check_version_exists(github_repo, target_version)
         private = pytest.args.config.tag_private_path(append_path(repo, path), {})
         fail = not private and not is_deprecated_spec(base) and path not in pytest.args.config.exceptions
         pytest.diffs[test].removed_spec(file, base_scope, fail)
@@ -161,6 +201,12 @@ def test_api(test):
     return
 
 
+def check_version_exists(repo, version):
+    """Raise an error if the given version (tag, branch or commit) does not exist in the repository."""
+    if not ref_exists(repo, version):
+        raise RuntimeError("Version {} not found in repository {}".format(version, repo))
+
+
 def validate_dummy_results(kind, result):
     expected_result = open("dummy/{}.txt".format(kind)).readlines()
     expected_result = {it.strip() for it in expected_result}
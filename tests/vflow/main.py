@@ -41,18 +41,28 @@ def parse_options(parser):
     return parser.parse_args()
 
 
+def get_vflow_file_patterns(solution):
+    """Return glob patterns for all repository files needed to check the operators of a solution."""
+    patterns = ["cfg/VERSION", "*/cfg/VERSION"]
+    for operator_dir in solution['operator-dirs']:
+        patterns.append(operator_dir + "/*")
+        if solution.get('settings-path'):
+            patterns.append(os.path.normpath(os.path.join(operator_dir, solution['settings-path'])))
+    return patterns
+
+
 def prepare_vflow_files(version, prefix, solution):
     """Download files for the given version and unpack them in a directory prefixed by prefix."""
     outdir = prefix + version
-    if os.path.isdir(outdir):  # do nothing if it's already there
-        return outdir
-
+    # The same files must be selected from Artifactory and GitHub, so nothing is excluded (operators might
+    # be located in test directories). Existing directories are reused if they have the same patterns.
+    patterns = get_vflow_file_patterns(solution)
     if re.match(r"^[0-9.]+$", version):
-        okay = download_from_artifactory(solution['group'], solution['artifact'], version, outdir)
+        okay = download_from_artifactory(solution['group'], solution['artifact'], version, outdir, include=patterns, exclude=[])
         if not okay:
-            download_repo_from_github(solution['repository'], "rel/" + version, outdir=outdir)
+            download_repo_from_github(solution['repository'], "rel/" + version, outdir=outdir, include=patterns, exclude=[])
     else:
-        download_repo_from_github(solution['repository'], version, outdir=outdir)
+        download_repo_from_github(solution['repository'], version, outdir=outdir, include=patterns, exclude=[])
 
     return outdir
 
@@ -1,3 +1,4 @@
+import itertools
 import logging as log
 import re
 import sys
@@ -6,11 +7,14 @@ from common import dig, get_operators, get_all_operators
 from fix import fixed
 
 sys.path.append(sys.path[0] + "/../../")
-from pylibs.diff import diff_tree
+from pylibs.diff import iter_diff
 
 # Some keys are not crucial and can be changed without any problems.
 MUTABLE_KEYS=["description", "title"]
 
+# Number of differences logged per changed key (all of them in verbose mode)
+MAX_DIFFS = 10
+
 def get_properties(root_dir):
     """Return the properties of all operators."""
     properties = {}
@@ -105,8 +109,12 @@ def check_property(op, pname, prop_old, prop_new, options):
         # keys may not be changed
         elif prop_new[key] != prop_old[key]:
             if not (key in MUTABLE_KEYS or fixed("pkey-chg", op, pname, key) or is_compatible_enum_change(key, prop_old[key], prop_new[key])):
-                diff = diff_tree(prop_old[key], prop_new[key], [key])
+                diffs = iter_diff(prop_old[key], prop_new[key], [key])
+                diff = list(diffs) if options.verbose else list(itertools.islice(diffs, MAX_DIFFS))
                 log.error("Operator %s: Property %s changed key %s\ndiff: %s", op, pname, key, [str(d) for d in diff])
+                more = sum(1 for _ in diffs)
+                if more:
+                    log.error("   ... and %d more (use --verbose)", more)
                 error_count += 1
                 if options.verbose:
                     log.error("   changed from %s to %s", prop_old[key], prop_new[key])
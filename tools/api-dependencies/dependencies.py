@@ -15,6 +15,7 @@ from pylibs.fileops import get_from_github_or_local, download_repo_from_github,
 MIN_ENDPOINT_LENGTH = 2
 
 FILE_WHITELIST = re.compile(".*\.(go|cpp|py|java|js|ts)$")
+SOURCE_PATTERNS = ["*.go", "*.cpp", "*.py", "*.java", "*.js", "*.ts"]
 
 # List of API endpoints with very generic names (as regular expressions).
 # These should be excluded from the heuristics of detecting use of an API.
@@ -219,8 +220,11 @@ def write_csv(dependencies, filename):
 
 
 def download_all_repositories(version):
+    # only source files (see FILE_WHITELIST) and specifications are needed
+    swagger_files = get_swagger_files()
     for repo in CODE_REPOSITORIES:
-        download_repo_from_github(repo, version)
+        spec_patterns = [f[len(repo) + 1:] for f in swagger_files.get(repo, []) if "://" not in f]
+        download_repo_from_github(repo, version, include=SOURCE_PATTERNS + spec_patterns + ["swagger.yaml", "*/swagger.yaml"])
 
 
 def get_all_endpoints(repositories):
@@ -2,17 +2,18 @@
 
 import argparse
 import csv
+import json
 import logging as log
 import os
 import re
-import subprocess
 import sys
 import time
 import requests
 
 sys.path.append(sys.path[0] + "/../../")
-from pylibs.fileops import parse_xml, read_json_from, unpack_file
-from pylibs.logstream import LogStream
+from pylibs import httpclient
+from pylibs.archive import Archive
+from pylibs.fileops import file_lock, read_pom, unpack_file
 
 
 # List of components within a release to check for Dockerfiles
@@ -39,68 +40,68 @@ def download_release_file(component, release_version):
     build_type = "milestones" if release_version.endswith("-ms") else "releases"
     POM_BASE = "https://int.repositories.cloud.sap/artifactory/build-" + build_type + "/com/sap/datahub/SAPDataHub/"
     try:
-        pom_xml = parse_xml(POM_BASE + release_version + "/SAPDataHub-" + release_version + ".pom")
+        pom = read_pom(POM_BASE + release_version + "/SAPDataHub-" + release_version + ".pom")
     except:
         log.fatal("version not found: %s", release_version)
         return ""
 
-    ## print("find", component, "in", [x.text for x in pom_xml.findall("dependencies/dependency/artifactId")])
-    dep = pom_xml.find("dependencies/dependency[artifactId='" + component + "']")
+    ## print("find", component, "in", [d.get("artifactId") for d in pom["dependencies"]])
+    dep = next((d for d in pom["dependencies"] if d.get("artifactId") == component), None)
     if dep is None:
         return (None, None)
 
-    version = dep.find("version").text
+    version = dep["version"]
     if version.startswith("${"):
-        version = pom_xml.find("properties/" + version[2:-1]).text
+        version = pom["properties"][version[2:-1]]
     filename = component + "-" + version
-    filename += "-" + dep.find("classifier").text if dep.find("classifier") is not None else ""
-    filename += "." + dep.find("type").text if dep.find("type") is not None else ".zip"
+    filename += "-" + dep["classifier"] if "classifier" in dep else ""
+    filename += "." + dep["type"] if "type" in dep else ".zip"
     url = "https://int.repositories.cloud.sap/artifactory/build-" + build_type + "/"
-    url += dep.find("groupId").text.replace(".", "/") + "/"
+    url += dep["groupId"].replace(".", "/") + "/"
     url += component + "/"
     url += version + "/" + filename
 
-    if not os.path.exists("components/"):
-        os.mkdir("components/")
+    os.makedirs("components/", exist_ok=True)
     filename_out = "components/" + filename
     if not os.path.exists(filename_out):
-        log.info("downloading %s", url)
-        dbg = LogStream(log.debug)
-        if subprocess.call(["curl", "-Lfk", url, "-o", filename_out, "--retry", str(12)], stderr=dbg) != 0:
-            log.fatal("cannot download package from %s", url)
-            sys.exit(-1)
+        with file_lock(filename_out):
+            if not os.path.exists(filename_out):
+                log.info("downloading %s", url)
+                if not httpclient.download(url, filename_out):
+                    log.fatal("cannot download package from %s", url)
+                    sys.exit(-1)
     return (filename_out, version)
 
 
-def find_dockerfiles_in(component_path):
-    """Find all Dockerfiles (with accompanying Tags.json) in the given path."""
+def find_dockerfiles_in(archive):
+    """Find all Dockerfiles (with accompanying Tags.json) in the given component archive."""
     dockerfiles = []
-    prefix_len = len(component_path) + 1
-    for path, subdirs, subfiles in os.walk(component_path):
+    for path, subdirs, subfiles in archive.walk():
         if "Dockerfile" in subfiles and "Tags.json" in subfiles:
-            dockerfiles.append(path[prefix_len:] + "/")
+            dockerfiles.append(path + "/")
     return dockerfiles
 
 
-def diff_docker(path, base_dir, target_dir):
+def diff_docker(path, base_archive, target_archive):
     """Find all differences between a Dockerfile in versions $base and $target.
     Includes the metadata in the accompanying Tags.json."""
-    base_path = base_dir + "/" + path
-    target_path = target_dir + "/" + path
-    if not os.path.isfile(base_path + "Dockerfile") and os.path.isfile(target_path + "Dockerfile"):
+    if not base_archive.isfile(path + "Dockerfile") and target_archive.isfile(path + "Dockerfile"):
         return [Diff("added-file", path, {}, {})]
-    if os.path.isfile(base_path + "Dockerfile") and not os.path.isfile(target_path + "Dockerfile"):
+    if base_archive.isfile(path + "Dockerfile") and not target_archive.isfile(path + "Dockerfile"):
         return [Diff("removed-file", path, {}, {})]
 
 
-    log.debug("comparing %s, versions %s and %s", path,
-              base_dir[base_dir.find("-")+1:], target_dir[target_dir.find("-")+1:])
-    base_docker = parse_dockerfile(open(base_path + "Dockerfile", 'r').read())
-    target_docker = parse_dockerfile(open(target_path + "Dockerfile", 'r').read())
+    log.debug("comparing %s in %s and %s", path, base_archive.filename, target_archive.filename)
+    with base_archive.open(path + "Dockerfile") as f:
+        base_docker = parse_dockerfile(f.read())
+    with target_archive.open(path + "Dockerfile") as f:
+        target_docker = parse_dockerfile(f.read())
     diff = diff_tree(base_docker, target_docker)
 
-    base_meta = read_json_from(base_path + "Tags.json")
-    target_meta = read_json_from(target_path + "Tags.json")
+    with base_archive.open(path + "Tags.json") as f:
+        base_meta = json.load(f)
+    with target_archive.open(path + "Tags.json") as f:
+        target_meta = json.load(f)
     diff += diff_tree(base_meta, target_meta, ["Tags"])
 
     # set kind to "deprecated" if the "deprecated" tag is added
@@ -210,17 +211,19 @@ def generate_csv(csv_writer, component, rversion_base, rversion_targ):
         log.warning("artifact Id %s not found in release %s", component, rversion_targ)
         return None
 
-    outdir_base = unpack_file(outfile_base, ".", make_subdir=True)
-    outdir_targ = unpack_file(outfile_targ, ".", make_subdir=True)
+    # Only the Dockerfiles are unpacked, they are used by tools/api-diff.
+    docker_patterns = ["Dockerfile", "*/Dockerfile", "Tags.json", "*/Tags.json"]
+    unpack_file(outfile_base, ".", make_subdir=True, include=docker_patterns)
+    unpack_file(outfile_targ, ".", make_subdir=True, include=docker_patterns)
 
-    dockerfiles = find_dockerfiles_in(outdir_base)
-    dockerfiles += [d for d in find_dockerfiles_in(outdir_targ) if d not in dockerfiles]
+    with Archive(outfile_base) as archive_base, Archive(outfile_targ) as archive_targ:
+        dockerfiles = find_dockerfiles_in(archive_base)
+        dockerfiles += [d for d in find_dockerfiles_in(archive_targ) if d not in dockerfiles]
+        if not dockerfiles:
+            log.warning("no dockerfiles in %s", component)
+        diffs = [(dockerfile, diff_docker(dockerfile, archive_base, archive_targ)) for dockerfile in dockerfiles]
 
-    if not dockerfiles:
-        log.warning("no dockerfiles in %s", component)
-
-    for dockerfile in dockerfiles:
-        diff = diff_docker(dockerfile, outdir_base, outdir_targ)
+    for dockerfile, diff in diffs:
         if diff:
             log.info("Differences found in %s: %s", component, dockerfile)
         for d in diff:
@@ -13,7 +13,7 @@ import yaml
 SCRIPT_DIR = sys.path[0]
 sys.path.append(SCRIPT_DIR + "/../")
 from pylibs.openapi import merge_specs
-from pylibs.fileops import get_from_github, get_from_github_or_local, download_repo_from_github, read_from_url_or_file
+from pylibs.fileops import get_from_github, get_from_github_or_local, get_many_from_github, download_repo_from_github, read_from_url_or_file
 
 
 GLOBALTITLE = "SAP Data Intelligence Service APIs"
@@ -59,6 +59,11 @@ def fetch_swagger_specs():
         log.error("No repositories found!")
         exit(1)
 
+    # fetch all files without a local copy concurrently from github
+    github_files = [(repo['name'], path, branch) for repo in repos for path in repo['swaggerFiles'] or []
+                    if "://" not in path and not os.path.isfile(os.path.join("repos", repo['name'], path))]
+    fetched = dict(zip(github_files, get_many_from_github(github_files)))
+
     swaggerFiles = []
     for repo in repos:
         repo_name = repo['name']
@@ -74,7 +79,11 @@ def fetch_swagger_specs():
             else:
                 # download from github. don't cache files, as these might be overwritten by merge_swagger_specs()
                 fullpath = os.path.join(repo_name, path)
-                file_content = get_from_github_or_local(repo_name, path, branch)
+                file_content = fetched.get((repo_name, path, branch))
+                if isinstance(file_content, Exception):
+                    raise file_content
+                if file_content is None:
+                    file_content = get_from_github_or_local(repo_name, path, branch)
             if file_content:
                 dirpath = os.path.splitext(fullpath)[0]
                 targetdir = os.path.join(outdir, dirpath)
@@ -101,7 +110,7 @@ def copy_schema_files():
     schema_dir = os.path.join(outdir, "datahub-app-data-" + branch)
     spec_dir = os.path.join(outdir, "bdh/datahub-app-data", "src/apps/dh-app-metadata/spec")
 
-    download_repo_from_github("bdh/datahub-app-data", branch, remove_archive=True, outdir=schema_dir)
+    download_repo_from_github("bdh/datahub-app-data", branch, outdir=schema_dir, include=["src/apps/dh-app-metadata/spec/schemas/*"])
     # Copy xml schemas referenced from the app-data documentation (no extra formatting)
     schema_dir = os.path.join(schema_dir, "src/apps/dh-app-metadata/spec/schemas")
     for spec in os.scandir(spec_dir):
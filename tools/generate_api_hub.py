@@ -6,7 +6,7 @@ import sys
 import yaml
 
 sys.path.append(sys.path[0] + "/../")
-from pylibs.fileops import get_from_github
+from pylibs.fileops import get_many_from_github
 from pylibs.openapi import extract_base_path, merge_specs, merge_selected_objects, filter_paths, purge_unused_definitions, rename_tag, retain_tags, remove_field
 from pylibs.versioning import handle_component, tag_to_version, version_to_tag
 
@@ -19,10 +19,19 @@ def get_component_version(component, ms_version):
     return version
 
 
-def fetch_spec(repo, path, version):
-    log.info("Fetching {}/{}".format(repo, path))
-    text = get_from_github(repo, path, version_to_tag(version), False)
-    return yaml.safe_load(text)
+def fetch_specs(specs):
+    """Fetch (repo, path, version) specifications concurrently and return them in the same order."""
+    for repo, path, _ in specs:
+        log.info("Fetching {}/{}".format(repo, path))
+    files = [(repo, path, version_to_tag(version)) for repo, path, version in specs]
+    result = []
+    for (repo, path, version), text in zip(files, get_many_from_github(files)):
+        if isinstance(text, Exception):
+            raise text
+        if text is False:
+            raise Exception("Specification not found: {}/{} in version {}".format(repo, path, version))
+        result.append(yaml.safe_load(text))
+    return result
 
 
 def add_servers(spec, name, path):
@@ -54,18 +63,23 @@ if __name__ == '__main__':
     diagnostics_version = get_component_version("bdh/diagnostics", args.version)
 
     # Fetch specifications
-    vflow_spec = fetch_spec("velocity/vflow", "src/stdlib/swagger.yaml", vflow_version)
-    vsystem_spec = fetch_spec("velocity/vsystem", "open-api/login-public.yaml", vsystem_version)
-    storagegateway_spec = fetch_spec("bigdataservices/storagegateway", "doc/api-spec/storagegateway-swagger.yaml", storagegateway_version)
-    metadata_browsing_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicBrowsing.yaml", metadata_version)
-    metadata_connection_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicConnection.yaml", metadata_version)
-    metadata_dataset_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicDataset.yaml", metadata_version)
-    metadata_lineage_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicLineage.yaml", metadata_version)
-    metadata_rules_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicRules.yaml", metadata_version)
-    metadata_scheduler_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicScheduler.yaml", metadata_version)
-    metadata_tagging_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicTagging.yaml", metadata_version)
-    metadata_swagger_spec = fetch_spec("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/swagger.yaml", metadata_version)
-    diagnostics_spec = fetch_spec("bdh/diagnostics", "src/open-api/monitoring-query.yaml", diagnostics_version)
+    (vflow_spec, vsystem_spec, storagegateway_spec,
+     metadata_browsing_spec, metadata_connection_spec, metadata_dataset_spec, metadata_lineage_spec,
+     metadata_rules_spec, metadata_scheduler_spec, metadata_tagging_spec, metadata_swagger_spec,
+     diagnostics_spec) = fetch_specs([
+        ("velocity/vflow", "src/stdlib/swagger.yaml", vflow_version),
+        ("velocity/vsystem", "open-api/login-public.yaml", vsystem_version),
+        ("bigdataservices/storagegateway", "doc/api-spec/storagegateway-swagger.yaml", storagegateway_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicBrowsing.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicConnection.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicDataset.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicLineage.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicRules.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicScheduler.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/publicTagging.yaml", metadata_version),
+        ("bdh/datahub-app-data", "src/apps/dh-app-metadata/spec/swagger.yaml", metadata_version),
+        ("bdh/diagnostics", "src/open-api/monitoring-query.yaml", diagnostics_version),
+    ])
 
     # Merge specifications
     log.info("Merging specifications")